@@ -0,0 +1,611 @@
+# 離線效能測試：以錄製或合成的全線 TDX 資料，量測各階段的吞吐量、延遲百分位數與記憶體峰值
+#
+#   python benchmark.py                        以固定亂數種子合成兩日時刻表與列車動態
+#   python benchmark.py --record fixtures      向 TDX 下載一份真實資料存成 fixtures
+#   python benchmark.py --fixtures fixtures    改用存下來的資料
+#   python benchmark.py --output before.json   存下結果，之後以 --compare before.json 比較
+
+import argparse
+import asyncio
+import gc
+import json
+import math
+import os
+import platform
+import random
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+
+from station_live import SERVICE_DAY_CUTOVER, StationLiveTable
+from station_map import StationTrainslator
+from station_table import StationTable, minutes_to_time, parse_station_table
+from train_live import TrainPositionTable
+from train_table import TrainTable, parse_train_data
+from train_type import TrainTypeTranslator
+from train_type_ailas import train_type_ailas
+
+TRAIN_DATE = "2026-03-02"
+
+# 凍結的時間點：早上尖峰、午夜、凌晨 3 點營運日交界
+SCENARIOS = {"rush_hour": "07:30", "midnight": "00:00", "cutover": "03:00"}
+
+FIXTURE_NAMES = (
+    "stations",
+    "train_types",
+    "station_table",
+    "station_table_tomorrow",
+    "train_table",
+    "train_table_tomorrow",
+    "train_live",
+)
+
+# 合成站名用的音節，中英文一一對應，組合後不會重複
+SYLLABLES = (
+    ("臺", "tai"), ("北", "bei"), ("南", "nan"), ("中", "zhong"), ("東", "dong"),
+    ("西", "xi"), ("新", "xin"), ("竹", "zhu"), ("山", "shan"), ("林", "lin"),
+    ("田", "tian"), ("港", "gang"), ("橋", "qiao"), ("水", "shui"), ("花", "hua"),
+    ("豐", "feng"), ("平", "ping"), ("安", "an"), ("和", "he"), ("興", "xing"),
+    ("源", "yuan"), ("埔", "pu"),
+)
+
+
+def iso_time(date, minutes):
+    moment = datetime.strptime(date, "%Y-%m-%d") + timedelta(minutes=minutes)
+    return moment.strftime("%Y-%m-%dT%H:%M:%S+08:00")
+
+
+def synthesize_stations(count):
+    stations = []
+    names = (
+        (first, second)
+        for first in SYLLABLES
+        for second in SYLLABLES
+        if first is not second
+    )
+    for index, ((zh1, en1), (zh2, en2)) in zip(range(count), names):
+        stations.append(
+            {
+                "StationID": str(1000 + index * 10),
+                "StationName": {"Zh_tw": zh1 + zh2, "En": (en1 + en2).capitalize()},
+                "StationClass": str(index % 4),
+            }
+        )
+    return stations
+
+
+def synthesize_train_types():
+    with open("train_type_static.json", "r", encoding="utf-8") as file:
+        static = json.load(file)
+    return [
+        {
+            "TrainTypeID": train_type_id,
+            "TrainTypeCode": item["TrainTypeCode"],
+            "TrainTypeName": item["TrainTypeName"],
+        }
+        for train_type_id, item in static.items()
+        if item["TrainTypeCode"] in train_type_ailas
+    ]
+
+
+def synthesize_schedule(rng, stations, train_types, train_count):
+    # 一條主線加上兩條支線，主線有區間車與長程對號列車，支線只有區間車
+    trunk = list(range(160))
+    branches = ([40] + list(range(160, 200)), [110] + list(range(200, 240)))
+    types_by_code = {}
+    for train_type in train_types:
+        types_by_code.setdefault(train_type["TrainTypeCode"], []).append(train_type)
+
+    trains = []
+    for train_index in range(train_count):
+        kind = rng.random()
+        if kind < 0.6:
+            start = rng.randrange(len(trunk) - 15)
+            route = trunk[start : start + rng.randint(15, 40)]
+            code, hop, skip = "6", 3, 1
+        elif kind < 0.85:
+            start = rng.randrange(40)
+            route = trunk[start : start + rng.randint(60, 160)]
+            code, hop, skip = rng.choice(("1", "2", "3")), 2, rng.randint(3, 5)
+        else:
+            route = list(rng.choice(branches))
+            code, hop, skip = "6", 4, 1
+        direction = rng.randrange(2)
+        if direction == 1:
+            route = route[::-1]
+        # 停靠站：起訖站一定停，中間依 skip 跳站
+        stops = [
+            station
+            for position, station in enumerate(route)
+            if position % skip == 0 or position == len(route) - 1
+        ]
+        if rng.random() < 0.3:
+            departure = rng.choice((rng.randint(390, 540), rng.randint(1020, 1170)))
+        else:
+            departure = rng.randint(300, 1400)
+        train_type = rng.choice(types_by_code.get(code) or train_types)
+
+        stop_times = []
+        minutes = departure
+        for sequence, station in enumerate(stops, start=1):
+            arrival = minutes
+            departure_minutes = arrival if sequence in (1, len(stops)) else arrival + 1
+            stop_times.append((sequence, stations[station], arrival, departure_minutes))
+            minutes = departure_minutes + hop * skip
+        trains.append(
+            {
+                "train_no": str(train_index + 1),
+                "direction": direction,
+                "train_type": train_type,
+                "stop_times": stop_times,
+            }
+        )
+    return trains
+
+
+def train_timetable_payload(trains, date):
+    timetables = []
+    for train in trains:
+        stop_times = train["stop_times"]
+        info = {
+            "TrainNo": train["train_no"],
+            "Direction": train["direction"],
+            "TrainTypeID": train["train_type"]["TrainTypeID"],
+            "TrainTypeCode": train["train_type"]["TrainTypeCode"],
+            "TrainTypeName": train["train_type"]["TrainTypeName"],
+            "StartingStationID": stop_times[0][1]["StationID"],
+            "StartingStationName": stop_times[0][1]["StationName"],
+            "EndingStationID": stop_times[-1][1]["StationID"],
+            "EndingStationName": stop_times[-1][1]["StationName"],
+            "TripLine": 0,
+            "WheelChairFlag": 1,
+            "PackageServiceFlag": 0,
+            "DiningFlag": 0,
+            "BikeFlag": 0,
+            "BreastFeedingFlag": 0,
+            "DailyFlag": 1,
+            "ServiceAddedFlag": 0,
+            "SuspendedFlag": 0,
+        }
+        for _, station, arrival, departure in stop_times:
+            if departure >= 24 * 60:
+                info["OverNightStationID"] = station["StationID"]
+                break
+        timetables.append(
+            {
+                "TrainInfo": info,
+                "StopTimes": [
+                    {
+                        "StopSequence": sequence,
+                        "StationID": station["StationID"],
+                        "StationName": station["StationName"],
+                        "ArrivalTime": minutes_to_time(arrival),
+                        "DepartureTime": minutes_to_time(departure),
+                        "SuspendedFlag": 0,
+                    }
+                    for sequence, station, arrival, departure in stop_times
+                ],
+            }
+        )
+    return {
+        "UpdateTime": iso_time(date, -120),
+        "UpdateInterval": 86400,
+        "SrcUpdateTime": iso_time(date, -180),
+        "SrcUpdateInterval": 86400,
+        "TrainDate": date,
+        "TrainTimetables": timetables,
+    }
+
+
+def station_timetable_payload(trains, date):
+    # 與 TDX 相同，每個車站每個方向一筆，終點站不列入
+    timetables = {}
+    for train in trains:
+        stop_times = train["stop_times"]
+        for sequence, station, arrival, departure in stop_times[:-1]:
+            key = (station["StationID"], train["direction"])
+            if key not in timetables:
+                timetables[key] = {
+                    "StationID": station["StationID"],
+                    "Direction": train["direction"],
+                    "TimeTables": [],
+                }
+            timetables[key]["TimeTables"].append(
+                {
+                    "Sequence": sequence,
+                    "TrainNo": train["train_no"],
+                    "DestinationStationID": stop_times[-1][1]["StationID"],
+                    "DestinationStationName": stop_times[-1][1]["StationName"],
+                    "TrainTypeID": train["train_type"]["TrainTypeID"],
+                    "TrainTypeCode": train["train_type"]["TrainTypeCode"],
+                    "TrainTypeName": train["train_type"]["TrainTypeName"],
+                    "ArrivalTime": minutes_to_time(arrival),
+                    "DepartureTime": minutes_to_time(departure),
+                }
+            )
+    for timetable in timetables.values():
+        timetable["TimeTables"].sort(key=lambda train: train["DepartureTime"])
+    return {
+        "UpdateTime": iso_time(date, -120),
+        "UpdateInterval": 86400,
+        "SrcUpdateTime": iso_time(date, -180),
+        "SrcUpdateInterval": 86400,
+        "TrainDate": date,
+        "StationTimetables": list(timetables.values()),
+    }
+
+
+def train_live_payload(rng, trains, date, now):
+    # 凌晨時前一天的跨日列車仍在線上，以加一天後的時間判斷
+    boards = []
+    for train in trains:
+        stop_times = train["stop_times"]
+        for minutes in (now, now + 24 * 60):
+            if stop_times[0][3] <= minutes < stop_times[-1][2]:
+                break
+        else:
+            continue
+        station = max(
+            (stop for stop in stop_times if stop[3] <= minutes), key=lambda stop: stop[0]
+        )[1]
+        roll = rng.random()
+        delay = 0 if roll < 0.6 else rng.randint(1, 10) if roll < 0.9 else rng.randint(11, 60)
+        boards.append(
+            {
+                "TrainNo": train["train_no"],
+                "TrainTypeID": train["train_type"]["TrainTypeID"],
+                "StationID": station["StationID"],
+                "DelayTime": delay,
+                "UpdateTime": iso_time(date, now),
+            }
+        )
+    return {
+        "UpdateTime": iso_time(date, now),
+        "UpdateInterval": 60,
+        "SrcUpdateTime": iso_time(date, now),
+        "SrcUpdateInterval": 60,
+        "TrainLiveBoards": boards,
+    }
+
+
+def perturb_live(rng, data):
+    # 下一次輪詢：約一成的列車延誤有變化
+    boards = []
+    for board in data["TrainLiveBoards"]:
+        board = dict(board)
+        if rng.random() < 0.1:
+            board["DelayTime"] = max(0, board["DelayTime"] + rng.randint(-2, 5))
+        boards.append(board)
+    return dict(data, TrainLiveBoards=boards)
+
+
+def synthesize_fixtures(seed, train_count):
+    rng = random.Random(seed)
+    stations = synthesize_stations(240)
+    train_types = synthesize_train_types()
+    today = synthesize_schedule(rng, stations, train_types, train_count)
+    # 明天的時刻表與今天大致相同，少數班次停駛
+    tomorrow = [train for train in today if rng.random() > 0.03]
+    tomorrow_date = (
+        datetime.strptime(TRAIN_DATE, "%Y-%m-%d") + timedelta(days=1)
+    ).strftime("%Y-%m-%d")
+    fixtures = {
+        "stations": {"Stations": stations},
+        "train_types": {"TrainTypes": train_types},
+        "station_table": station_timetable_payload(today, TRAIN_DATE),
+        "station_table_tomorrow": station_timetable_payload(tomorrow, tomorrow_date),
+        "train_table": train_timetable_payload(today, TRAIN_DATE),
+        "train_table_tomorrow": train_timetable_payload(tomorrow, tomorrow_date),
+    }
+    live = {}
+    for scenario, clock in SCENARIOS.items():
+        hour, minute = map(int, clock.split(":"))
+        live[scenario] = train_live_payload(rng, today, TRAIN_DATE, hour * 60 + minute)
+    return fixtures, live
+
+
+def load_fixtures(path):
+    fixtures = {}
+    for name in FIXTURE_NAMES:
+        with open(os.path.join(path, f"{name}.json"), "r", encoding="utf-8") as file:
+            fixtures[name] = json.load(file)
+    live = fixtures.pop("train_live")
+    # 錄製的列車動態只有一份，所有情境共用
+    return fixtures, {scenario: live for scenario in SCENARIOS}
+
+
+async def record_fixtures(path):
+    import station_map
+    import station_table
+    import train_live
+    import train_table
+    import train_type
+    from tdx_requester import TDXRequester
+
+    today = datetime.now().strftime("%Y-%m-%d")
+    tomorrow = (datetime.now() + timedelta(days=1)).strftime("%Y-%m-%d")
+    queries = {
+        "stations": f"{station_map.query_path}?{station_map.query_args}",
+        "train_types": train_type.QUERY_PATH,
+        "station_table": f"{station_table.QUERY_PATH_DATE}/{today}?{station_table.QUERY_ARGS}",
+        "station_table_tomorrow": f"{station_table.QUERY_PATH_DATE}/{tomorrow}?{station_table.QUERY_ARGS}",
+        "train_table": f"{train_table.QUERY_PATH_DATE}/{today}",
+        "train_table_tomorrow": f"{train_table.QUERY_PATH_DATE}/{tomorrow}",
+        "train_live": f"{train_live.query_path}?{train_live.query_args}",
+    }
+    os.makedirs(path, exist_ok=True)
+    requester = TDXRequester()
+    try:
+        for name, subpath in queries.items():
+            data = await requester.get(subpath)
+            with open(os.path.join(path, f"{name}.json"), "w", encoding="utf-8") as file:
+                json.dump(data, file, ensure_ascii=False)
+            print(f"Recorded {name}")
+    finally:
+        await requester.close()
+
+
+def percentile(samples, percent):
+    ordered = sorted(samples)
+    index = max(0, math.ceil(len(ordered) * percent / 100) - 1)
+    return ordered[index]
+
+
+def run_stage(name, ops, repeat):
+    # ops 為一組無參數函式，回傳處理的筆數；每個函式各計時一次作為一個延遲樣本
+    gc.collect()
+    for op in ops:
+        op()
+    samples = []
+    items = 0
+    for _ in range(repeat):
+        for op in ops:
+            start = time.perf_counter_ns()
+            items += op()
+            samples.append(time.perf_counter_ns() - start)
+    # 記憶體峰值另外跑一次，避免 tracemalloc 的開銷影響計時
+    gc.collect()
+    tracemalloc.start()
+    for op in ops:
+        op()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    total = sum(samples) / 1e9
+    result = {
+        "samples": len(samples),
+        "items": items,
+        "throughput": items / total if total else 0.0,
+        "p50_ms": percentile(samples, 50) / 1e6,
+        "p90_ms": percentile(samples, 90) / 1e6,
+        "p99_ms": percentile(samples, 99) / 1e6,
+        "max_ms": max(samples) / 1e6,
+        "peak_kib": peak / 1024,
+    }
+    print(
+        f"{name:<36} {result['samples']:>7} {result['throughput']:>12.0f}"
+        f" {result['p50_ms']:>9.3f} {result['p90_ms']:>9.3f} {result['p99_ms']:>9.3f}"
+        f" {result['max_ms']:>9.3f} {result['peak_kib']:>10.0f}"
+    )
+    return result
+
+
+def frozen_now(train_date, clock):
+    # 換日線之前的時間屬於營運日的隔天凌晨
+    now = datetime.strptime(f"{train_date} {clock}", "%Y-%m-%d %H:%M")
+    if now.hour * 60 + now.minute < SERVICE_DAY_CUTOVER:
+        now += timedelta(days=1)
+    return now
+
+
+def build_tables(fixtures):
+    station_table = StationTable(fixtures["station_table"]["TrainDate"]).parse(
+        fixtures["station_table"]
+    )
+    station_table_tomorrow = StationTable(
+        fixtures["station_table_tomorrow"]["TrainDate"]
+    ).parse(fixtures["station_table_tomorrow"])
+    train_table = TrainTable(fixtures["train_table"]["TrainDate"]).parse(
+        fixtures["train_table"]
+    )
+    train_table_tomorrow = TrainTable(
+        fixtures["train_table_tomorrow"]["TrainDate"]
+    ).parse(fixtures["train_table_tomorrow"])
+    station_table.apply_overnight(train_table)
+    station_table_tomorrow.apply_overnight(train_table_tomorrow)
+    return SimpleNamespace(
+        station_table=station_table,
+        station_table_tomorrow=station_table_tomorrow,
+        train_table=train_table,
+        train_table_tomorrow=train_table_tomorrow,
+        station_id_translator=StationTrainslator().parse(fixtures["stations"]),
+        train_type_translator=TrainTypeTranslator(ailas=True).parse(
+            fixtures["train_types"]["TrainTypes"]
+        ),
+        station_live_table=None,
+        generation=0,
+    )
+
+
+def lookup_ops(rng, translator, batches, batch_size=100):
+    keys = []
+    for station_id, (name_zh, name_en, _) in translator.items():
+        keys.extend((station_id, name_zh, name_en))
+
+    def batch():
+        for key in rng.sample(keys, batch_size):
+            translator[key]
+            translator.id(key)
+            key in translator
+            translator.search(key[:2])
+        return batch_size * 4
+
+    return [batch] * batches
+
+
+def view_keys(rng, resources, count):
+    station_ids = sorted(resources.station_table.keys())
+    keys = []
+    for _ in range(count):
+        station_id = rng.choice(station_ids)
+        destination_id = rng.choice(station_ids) if rng.random() < 0.5 else None
+        keys.append(
+            (station_id, rng.choice((None, 0, 1)), rng.choice((3, 5, 10)), destination_id)
+        )
+    return keys
+
+
+def render_ops(resources, keys):
+    try:
+        import discord_bot
+    except ImportError as e:
+        print(f"Skipping render_view: {e}")
+        return None
+    discord_bot.resource_provider = resources
+
+    def render(view_key):
+        def op():
+            discord_bot.render_view(*view_key)
+            return 1
+
+        return op
+
+    return [render(view_key) for view_key in keys]
+
+
+def run_benchmark(fixtures, live, repeat, seed):
+    rng = random.Random(seed)
+    results = {}
+    print(
+        f"{'stage':<36} {'samples':>7} {'items/s':>12} {'p50 ms':>9} {'p90 ms':>9}"
+        f" {'p99 ms':>9} {'max ms':>9} {'peak KiB':>10}"
+    )
+
+    def parse_stations():
+        items = 0
+        for name in ("station_table", "station_table_tomorrow"):
+            data = fixtures[name]
+            stations = parse_station_table(data, data["TrainDate"])
+            items += sum(len(station.trains) for station in stations.values())
+        return items
+
+    def parse_trains():
+        items = 0
+        for name in ("train_table", "train_table_tomorrow"):
+            trains = parse_train_data(fixtures[name])
+            items += sum(len(train.stop_table.table) for train in trains.values())
+        return items
+
+    results["parse_station_table"] = run_stage(
+        "parse_station_table", [parse_stations], repeat
+    )
+    results["parse_train_data"] = run_stage("parse_train_data", [parse_trains], repeat)
+
+    resources = build_tables(fixtures)
+    train_date = resources.station_table.date
+    results["StationTrainslator lookups"] = run_stage(
+        "StationTrainslator lookups",
+        lookup_ops(rng, resources.station_id_translator, 100),
+        repeat,
+    )
+
+    for scenario, clock in SCENARIOS.items():
+        now = frozen_now(train_date, clock)
+        train_pos_table = TrainPositionTable().parse(live[scenario])
+        next_pos_table = TrainPositionTable().parse(perturb_live(rng, live[scenario]))
+
+        def build_live():
+            table = StationLiveTable(
+                resources.station_table,
+                resources.station_table_tomorrow,
+                train_pos_table,
+                now,
+            )
+            return len(table.values())
+
+        def update_live():
+            table.update(next_pos_table, now)
+            table.update(train_pos_table, now)
+            return 2
+
+        name = f"StationLiveTable[{scenario}]"
+        results[name] = run_stage(name, [build_live], repeat)
+
+        table = StationLiveTable(
+            resources.station_table,
+            resources.station_table_tomorrow,
+            train_pos_table,
+            now,
+        )
+        table.values()
+        name = f"StationLiveTable.update[{scenario}]"
+        results[name] = run_stage(name, [update_live], repeat)
+
+        resources.station_live_table = table
+        ops = render_ops(resources, view_keys(rng, resources, 200))
+        if ops is not None:
+            name = f"render_view[{scenario}]"
+            results[name] = run_stage(name, ops, repeat)
+    return results
+
+
+def compare(results, path):
+    with open(path, "r", encoding="utf-8") as file:
+        baseline = json.load(file)["stages"]
+    print()
+    print(f"{'stage':<36} {'items/s':>10} {'p50':>10} {'p99':>10} {'peak':>10}")
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        before = baseline[name]
+        print(
+            f"{name:<36}"
+            + "".join(
+                f" {(result[key] / before[key] - 1) * 100 if before[key] else 0:>+9.1f}%"
+                for key in ("throughput", "p50_ms", "p99_ms", "peak_kib")
+            )
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline performance benchmark")
+    parser.add_argument("--fixtures", help="directory of recorded TDX payloads")
+    parser.add_argument("--record", help="record TDX payloads into this directory")
+    parser.add_argument("--seed", type=int, default=20260302)
+    parser.add_argument("--trains", type=int, default=1000, help="synthesized trains per day")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--output", help="write results as JSON")
+    parser.add_argument("--compare", help="compare with a previous --output file")
+    args = parser.parse_args()
+
+    if args.record:
+        asyncio.run(record_fixtures(args.record))
+        return
+    if args.fixtures:
+        fixtures, live = load_fixtures(args.fixtures)
+    else:
+        fixtures, live = synthesize_fixtures(args.seed, args.trains)
+
+    results = run_benchmark(fixtures, live, args.repeat, args.seed)
+    if args.compare:
+        compare(results, args.compare)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as file:
+            json.dump(
+                {
+                    "meta": {
+                        "time": datetime.now().isoformat(timespec="seconds"),
+                        "python": platform.python_version(),
+                        "fixtures": args.fixtures or f"synthesized seed={args.seed} trains={args.trains}",
+                        "repeat": args.repeat,
+                    },
+                    "stages": results,
+                },
+                file,
+                ensure_ascii=False,
+                indent=4,
+            )
+
+
+if __name__ == "__main__":
+    main()
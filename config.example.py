@@ -15,5 +15,40 @@ tdx_api_root = f"https://tdx.transportdata.tw/api/basic"
 
 tdx_relay_server_port = 50232
 
+# 中繼站代為請求的其他路徑：依路徑前綴的快取秒數、未列出時的秒數與總位元組上限 (optional)
+#relay_cache_ttls = {"/v3/Rail/TRA/TrainLiveBoard": 20, "/v3/Rail/TRA/Station": 86400}
+#relay_cache_default_ttl = 60
+#relay_cache_max_bytes = 64 << 20
+
+# TDX connection pool (optional)
+#tdx_connection_limit = 16
+#tdx_keepalive_timeout = 60
+#tdx_dns_cache_ttl = 600
+
+# TDX 方案的每秒請求額度與重試次數 (optional)
+#tdx_rate_limit = 5
+#tdx_rate_burst = 5
+#tdx_max_retries = 8
+
+# 中繼站逾時與對沖請求的延遲預算，None 為該中繼站平均延遲的兩倍 (optional)
+#tdx_relay_timeout = 10
+#tdx_relay_hedge_after = None
+
+# 每日時刻表快照存放位置 (optional)
+#snapshot_dir = "snapshots"
+
+# 由列車時刻表反轉產生車站時刻表，每日只需下載列車時刻表 (optional)
+#derive_station_table = True
+
+# sharded_bot.py 的分片程序數與 Discord 分片總數 (optional)
+#shard_workers = 2
+#shard_count = 2
+
+# Prometheus 指標的 HTTP 埠，sharded_bot.py 的分片程序使用其後的埠 (optional)
+#metrics_port = 9100
+
+# 監視器任務資料庫，舊的 stored_tasks.json 會在第一次啟動時匯入 (optional)
+#task_db_path = "tasks.db"
+
 import logging
 log_level = logging.INFO
\ No newline at end of file
@@ -1,14 +1,16 @@
 import discord
+from discord import app_commands
 from discord.ext import commands
 import datetime
 from resource_provider import ResourceProvider
 from tdx_requester import TDXRequester as tdx_requester
+from task_store import TaskStore
 import config
-import json
 import os
-import schedule
 import asyncio
 import logging
+import time
+import metrics
 
 # 設定日誌格式
 logging.basicConfig(
@@ -25,7 +27,177 @@ BOT_TOKEN = config.bot_token
 # Discord 機器人設定
 intents = discord.Intents.default()
 intents.message_content = True
-bot = commands.Bot(command_prefix="/", intents=intents)
+
+# 由 sharded_bot.py 啟動時，每個程序只負責部分分片
+SHARD_IDS = os.environ.get("DBOTDX_SHARD_IDS")
+if SHARD_IDS is not None:
+    bot = commands.AutoShardedBot(
+        command_prefix="/",
+        intents=intents,
+        shard_ids=[int(shard_id) for shard_id in SHARD_IDS.split(",")],
+        shard_count=int(os.environ["DBOTDX_SHARD_COUNT"]),
+    )
+else:
+    bot = commands.Bot(command_prefix="/", intents=intents)
+
+# 列車動態每 20 秒更新一次，超過這個時間才完成的監視器更新就是落後
+UPDATE_INTERVAL = 20
+METRICS_PORT = (
+    int(os.environ["DBOTDX_METRICS_PORT"])
+    if "DBOTDX_METRICS_PORT" in os.environ
+    else metrics.metrics_port
+)
+metrics_runner = None
+resource_provider = None
+task_store = None
+initializing = False  # on_ready 開始初始化後設定，重新連線時不再重複
+ready = False  # 資料、任務資料庫與監視器都初始化完成後才接受指令
+
+message_edits = metrics.counter(
+    "discord_message_edits_total",
+    "Monitor updates by outcome: edited, skipped (display unchanged) or failed",
+    ("result",),
+)
+edit_seconds = metrics.histogram("discord_edit_seconds", "Time for one message edit")
+view_renders = metrics.counter(
+    "discord_view_renders_total", "Monitor views rendered or served from cache", ("result",)
+)
+monitor_count = metrics.gauge("discord_monitors", "Active station monitors")
+update_lag = metrics.histogram(
+    "discord_monitor_update_lag_seconds",
+    "Time from the update slot until a monitor finished updating",
+    buckets=(0.5, 1, 2, 5, 10, 20, 30, 60, 120),
+)
+monitors_behind = metrics.counter(
+    "discord_monitors_behind_total",
+    "Monitor updates that finished after the next update slot",
+)
+
+
+def render_view(station_id, direction, count, destination_id):
+    display = ""
+    service_lives = resource_provider.station_live_table[station_id].sorted(direction)
+    if destination_id is not None:
+        # 以預先建立的索引找出會依序停靠本站與目的地的車次，湊滿 count 班即停止
+        reachable = (
+            resource_provider.train_table.reachable(station_id, destination_id),
+            resource_provider.train_table_tomorrow.reachable(station_id, destination_id),
+        )
+        filtered_service_lives = []
+        for service_live in service_lives:
+            if service_live.train_no in reachable[service_live.day]:
+                filtered_service_lives.append(service_live)
+                if len(filtered_service_lives) >= count:
+                    break
+        service_lives = filtered_service_lives
+    for service_live in service_lives[:count]:
+        train_no = service_live.train_no.ljust(7, " ")
+        dest = resource_provider.station_id_translator[service_live.dest].ljust(
+            4, "　"
+        )
+        train_type = resource_provider.train_type_translator[
+            service_live.train_type
+        ].ljust(4, "　")
+        scheduled_departure = service_live.scheduled_departure.ljust(8, " ")
+        delay_status = (
+            "未發車"
+            if service_live.delay is None or service_live.departed
+            else f"晚{service_live.delay}分" if service_live.delay > 0 else "準點"
+        )
+        display += f"```{train_no} {dest} {train_type} {scheduled_departure} {delay_status}```"
+    title = f"{resource_provider.station_id_translator[station_id]}站 "
+    title += f"{'' if direction is None else '順行 ' if direction == 0 else '逆行'}"
+    if destination_id is not None:
+        dest = resource_provider.station_id_translator[destination_id]
+        title += f" 往{dest}"
+    embed = discord.Embed(
+        title=title,
+        color=discord.Color.blue(),
+        timestamp=datetime.datetime.now(),
+        description=display,
+    )
+    return display, embed
+
+
+class MonitorRegistry:
+    # 相同車站、方向、目的地與數量的監視器共用同一份畫面，每個動態版本只繪製一次
+    def __init__(self):
+        self.views = {}  # view_key -> {message_id: StationMonitor}
+        self.rendered = {}  # view_key -> (generation, display, embed)
+        self.task = None
+
+    def register(self, monitor):
+        if monitor.view_key not in self.views:
+            self.views[monitor.view_key] = {}
+        self.views[monitor.view_key][monitor.message_id] = monitor
+        monitor_count.set(self.count())
+
+    def unregister(self, monitor):
+        monitors = self.views.get(monitor.view_key, {})
+        monitors.pop(monitor.message_id, None)
+        if not monitors:
+            self.views.pop(monitor.view_key, None)
+            self.rendered.pop(monitor.view_key, None)
+        monitor_count.set(self.count())
+
+    def count(self):
+        return sum(len(monitors) for monitors in self.views.values())
+
+    def render(self, view_key):
+        generation = resource_provider.generation
+        rendered = self.rendered.get(view_key)
+        if rendered is None or rendered[0] != generation:
+            rendered = (generation, *render_view(*view_key))
+            self.rendered[view_key] = rendered
+            view_renders.inc(result="rendered")
+        else:
+            view_renders.inc(result="cached")
+        return rendered[1:]
+
+    def start(self):
+        if self.task is None:
+            self.task = asyncio.create_task(self.run())
+        return self
+
+    async def run(self):
+        # 每個新的列車動態版本發布後更新一次，更新期間又有新版本時只處理最新的
+        generation = resource_provider.generation
+        while True:
+            generation = await resource_provider.wait_generation(generation)
+            try:
+                await self.update_all()
+            except Exception as e:
+                logging.error(f"Failed to update monitors: {e}")
+
+    async def update_all(self):
+        # 從這一版資料的更新時間點算起，而不是開始編輯訊息的時間，才包含取得、套用與繪製的時間
+        slot = resource_provider.generation_slot
+        updates = []
+        for view_key, monitors in list(self.views.items()):
+            display, embed = self.render(view_key)
+            for monitor in list(monitors.values()):
+                updates.append(
+                    self.timed_update(slot, monitor.update_monitor(display, embed))
+                )
+        results = await asyncio.gather(*updates, return_exceptions=True)
+        for result in results:
+            if isinstance(result, Exception):
+                logging.error(f"Failed to update monitor: {result}")
+
+    async def timed_update(self, slot, update):
+        try:
+            await update
+        except Exception:
+            message_edits.inc(result="failed")
+            raise
+        finally:
+            lag = time.time() - slot
+            update_lag.observe(lag)
+            if lag > UPDATE_INTERVAL:
+                monitors_behind.inc()
+
+
+monitor_registry = MonitorRegistry()
 
 
 class StationMonitor:
@@ -47,6 +219,11 @@ class StationMonitor:
         self.interaction = interaction
         self.previous_display = None
         self.destination_id = destination_id
+        self.message = None
+
+    @property
+    def view_key(self):
+        return (self.station_id, self.direction, self.count, self.destination_id)
 
     async def start_monitor(self):
         if self.interaction is not None:
@@ -54,77 +231,50 @@ class StationMonitor:
             response = await self.interaction.original_response()
             self.message_id = response.id
             self.channel_id = response.channel.id
-            schedule.every().minute.at(":00").do(
-                lambda: asyncio.create_task(self.update_monitor())
-            )
-            schedule.every().minute.at(":20").do(
-                lambda: asyncio.create_task(self.update_monitor())
-            )
-            schedule.every().minute.at(":40").do(
-                lambda: asyncio.create_task(self.update_monitor())
-            )
-        
+        # 以頻道與訊息 ID 建立部分訊息，更新時直接編輯，不必每次都查詢頻道與訊息
+        self.message = bot.get_partial_messageable(self.channel_id).get_partial_message(
+            self.message_id
+        )
+        monitor_registry.register(self)
+
         await self.update_monitor()
         return self
 
-    async def update_monitor(self):
+    async def update_monitor(self, display=None, embed=None):
         logging.debug(f"Updating monitor for station {self.station_id}")
-        display = ""
-        service_lives = resource_provider.station_live_table[self.station_id].sorted(self.direction)
-        filtered_service_lives = []
-        if self.destination_id is not None:
-            for service_live in service_lives:
-                service_table = resource_provider.train_table
-                service_table_tomorrow = resource_provider.train_table_tomorrow
-                if service_live.train_no in service_table:
-                    service = service_table[service_live.train_no]
-                elif service_live.train_no in service_table_tomorrow:
-                    service = resource_provider.train_table_tomorrow[
-                        service_live.train_no
-                    ]
-                else:
-                    continue
-                if self.destination_id in service:
-                    if (
-                        service[self.destination_id].stop_seq
-                        > service[self.station_id].stop_seq
-                    ):
-                        filtered_service_lives.append(service_live)
-            service_lives = filtered_service_lives
-        for service_live in service_lives[: self.count]:
-            train_no = service_live.train_no.ljust(7, " ")
-            dest = resource_provider.station_id_translator[service_live.dest].ljust(
-                4, "　"
-            )
-            train_type = resource_provider.train_type_translator[
-                service_live.train_type
-            ].ljust(4, "　")
-            scheduled_departure = service_live.scheduled_departure.ljust(8, " ")
-            delay_status = (
-                "未發車"
-                if service_live.delay is None or service_live.departed
-                else f"晚{service_live.delay}分" if service_live.delay > 0 else "準點"
-            )
-            display += f"```{train_no} {dest} {train_type} {scheduled_departure} {delay_status}```"
+        if display is None:
+            display, embed = monitor_registry.render(self.view_key)
         if display == self.previous_display:
+            message_edits.inc(result="skipped")
             return
-        title = f"{resource_provider.station_id_translator[self.station_id]}站 "
-        title += f"{'' if self.direction is None else '順行 ' if self.direction == 0 else '逆行'}"
-        if self.destination_id is not None:
-            dest = resource_provider.station_id_translator[self.destination_id]
-            title += f" 往{dest}"
-        embed = discord.Embed(
-            title=title,
-            color=discord.Color.blue(),
-            timestamp=datetime.datetime.now(),
-            description=display,
-        )
-        channel = await bot.fetch_channel(self.channel_id)
-        message = await channel.fetch_message(self.message_id)
-        await message.edit(embed=embed, content=None)
+        try:
+            with edit_seconds.time():
+                await self.message.edit(embed=embed, content=None)
+        except (discord.NotFound, discord.Forbidden):
+            # 部分訊息失效時才重新查詢，查不到代表訊息已被刪除
+            try:
+                channel = await bot.fetch_channel(self.channel_id)
+                self.message = await channel.fetch_message(self.message_id)
+                await self.message.edit(embed=embed, content=None)
+            except discord.NotFound:
+                message_edits.inc(result="failed")
+                logging.info(f"Message {self.message_id} was deleted, removing monitor")
+                await self.stop_monitor(remove_task=True)
+                return
+            except discord.Forbidden:
+                message_edits.inc(result="failed")
+                logging.warning(f"No permission to edit message {self.message_id}, stopping monitor")
+                await self.stop_monitor()
+                return
+        message_edits.inc(result="edited")
         logging.info(f"Updated monitor for station {self.station_id}")
         self.previous_display = display
 
+    async def stop_monitor(self, remove_task=False):
+        monitor_registry.unregister(self)
+        if remove_task:
+            await delete_task(self.message_id)
+
 
 # /station 指令
 @bot.tree.command(name="station")
@@ -135,15 +285,14 @@ async def station(
     count: int = 3,
     destination_id: str = None,
 ):
+    if not ready:
+        await interaction.response.send_message("機器人尚未準備好，請稍後再試", ephemeral=True)
+        return
     try:
         station_id_translator = resource_provider.station_id_translator
-        station_id = station_id_translator.id(
-            station_id.replace("車站", "").replace("站", "").replace("台", "臺")
-        )
+        station_id = station_id_translator.resolve(station_id)
         destination_id = (
-            station_id_translator.id(
-                destination_id.replace("車站", "").replace("站", "").replace("台", "臺")
-            )
+            station_id_translator.resolve(destination_id)
             if destination_id is not None
             else None
         )
@@ -153,36 +302,48 @@ async def station(
         await monitor.start_monitor()
         tasks = {}
         tasks["channel_id"] = monitor.channel_id
+        tasks["guild_id"] = interaction.guild_id
         tasks["message_id"] = monitor.message_id
         tasks["station_id"] = station_id
         tasks["destination_id"] = destination_id
         tasks["direction"] = direction
         tasks["count"] = count
-        if json_data.get("tasks") is None:
-            json_data["tasks"] = {}
-        if json_data["tasks"].get("station") is None:
-            json_data["tasks"]["station"] = {}
-        json_data["tasks"]["station"][monitor.message_id] = tasks
-        await save_tasks(json_data)
+        await task_store.insert(tasks)
 
     except Exception as e:
         raise Exception(f"Failed to start monitor: {e}")
 
 
-async def restore_tasks(data):
-    if not os.path.exists("stored_tasks.json"):
-        return
+@station.autocomplete("station_id")
+@station.autocomplete("destination_id")
+async def station_autocomplete(interaction: discord.Interaction, current: str):
+    # 以預先建立的前綴索引查詢，資料尚未載入時不提供建議
+    if not ready:
+        return []
+    station_id_translator = resource_provider.station_id_translator
+    choices = []
+    for station_id in station_id_translator.search(current):
+        name_zh, name_en, _ = station_id_translator.station_namemap[station_id]
+        choices.append(
+            app_commands.Choice(name=f"{name_zh} {name_en} ({station_id})", value=station_id)
+        )
+    return choices
+
+
+def task_shard_id(task):
+    # 與 Discord 相同的分片算法；私訊與沒有記錄 guild_id 的舊任務由分片 0 負責
+    if task.get("guild_id") is None:
+        return 0
+    return (task["guild_id"] >> 22) % bot.shard_count
 
-    with open("stored_tasks.json", "r", encoding="utf-8") as file:
-        try:
-            data.update(json.load(file))
-            if not data:
-                return
-        except json.JSONDecodeError:
-            return
 
-    tasks = data.get("tasks", {}).get("station", {})
-    for task in tasks.values():
+async def restore_tasks():
+    tasks = await task_store.all()
+    # 分片模式下只還原本程序負責的分片，不依賴頻道快取，私訊與討論串也能還原
+    if SHARD_IDS is not None:
+        tasks = [task for task in tasks if task_shard_id(task) in bot.shard_ids]
+    resource_provider.station_live_table.prewarm({task["station_id"] for task in tasks})
+    for task in tasks:
         message_id = task["message_id"]
         channel_id = task["channel_id"]
         station_id = task["station_id"]
@@ -205,38 +366,35 @@ async def restore_tasks(data):
         await monitor.start_monitor()
 
 
-async def save_tasks(data):
-    with open("stored_tasks.json", "w", encoding="utf-8") as file:
-        json.dump(data, file, ensure_ascii=False, indent=4)
+async def delete_task(message_id):
+    await task_store.delete(message_id)
+
+
+async def create_resource_provider():
+    return await ResourceProvider(tdx_requester()).fetch_init()
 
 
 # 啟動機器人
 @bot.event
 async def on_ready():
-    global resource_provider
-    resource_provider = await ResourceProvider(tdx_requester()).fetch_init()
-    schedule.every().day.at("00:00").do(
-        lambda: asyncio.create_task(resource_provider.fetch_daily())
-    ).tag("fetch_daily")
-    schedule.every().minute.at(":00").do(
-        lambda: asyncio.create_task(resource_provider.fetch_live())
-    ).tag("fetch_live")
-    schedule.every().minute.at(":20").do(
-        lambda: asyncio.create_task(resource_provider.fetch_live())
-    ).tag("fetch_live")
-    schedule.every().minute.at(":40").do(
-        lambda: asyncio.create_task(resource_provider.fetch_live())
-    ).tag("fetch_live")
-    await bot.tree.sync()
+    global resource_provider, metrics_runner, task_store, initializing, ready
+    # 重新連線時也會觸發 on_ready，資料與監視器只需初始化一次；
+    # 要在第一個 await 之前標記，否則初始化期間重新連線會再初始化一次
+    if initializing:
+        return
+    initializing = True
+    if METRICS_PORT is not None and metrics_runner is None:
+        metrics_runner = await metrics.start_server(METRICS_PORT)
+    resource_provider = (await create_resource_provider()).start()
+    # 指令是全域的，只需由負責分片 0 的程序同步一次
+    if SHARD_IDS is None or 0 in bot.shard_ids:
+        await bot.tree.sync()
     print(f"Logged on as {bot.user} (ID: {bot.user.id})")
-    global json_data
-    json_data = {}
-    await restore_tasks(json_data)
-    bot.loop.create_task(schedule_task())
+    task_store = await TaskStore().open()
+    await restore_tasks()
+    monitor_registry.start()
+    ready = True
 
-async def schedule_task():
-    while True:
-        schedule.run_pending()
-        await asyncio.sleep(1)  # 每秒檢查一次是否有任務需要執行
 
-bot.run(BOT_TOKEN)
+if __name__ == "__main__":
+    bot.run(BOT_TOKEN)
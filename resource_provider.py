@@ -1,16 +1,75 @@
 import asyncio
+import logging
+import time
+from snapshot import load_snapshot, save_snapshot
 from station_table import StationTable
 from train_table import TrainTable
 from train_live import TrainPositionTable
 from station_map import StationTrainslator
 from train_type import TrainTypeTranslator
-from station_live import StationLiveTable
-from datetime import datetime, timedelta
+from station_live import (
+    SERVICE_DAY_CUTOVER,
+    StationLiveTable,
+    service_date,
+    service_dates,
+)
+from station_table import minutes_to_time
+import config
+import metrics
+from scheduler import run_daily, run_every
+
+logger = logging.getLogger(__name__)
+
+fetch_seconds = metrics.histogram(
+    "provider_fetch_seconds", "Time to fetch and parse TDX data", ("kind",)
+)
+fetch_errors = metrics.counter(
+    "provider_fetch_errors_total", "Failed fetch_daily/fetch_live calls", ("kind",)
+)
+live_table_seconds = metrics.histogram(
+    "station_live_table_seconds",
+    "Time to build or update the station live table",
+    ("operation",),
+)
+live_generation = metrics.gauge(
+    "station_live_generation", "Current station live table generation"
+)
+live_trains = metrics.gauge("train_live_trains", "Trains on the latest live board")
+
+# 列車動態每 20 秒取得一次 (:00/:20/:40)，每日時刻表於營運日換日時更新
+live_interval = 20
+daily_at = minutes_to_time(SERVICE_DAY_CUTOVER)
+
+
+def snapshot_tables(snapshot):
+    # 由快照重建各個資料表，不涉及事件迴圈，可在執行緒中執行
+    return (
+        StationTable().from_snapshot(snapshot["station_table"]),
+        StationTable().from_snapshot(snapshot["station_table_tomorrow"]),
+        TrainTable().from_snapshot(snapshot["train_table"]),
+        TrainTable().from_snapshot(snapshot["train_table_tomorrow"]),
+        StationTrainslator().from_snapshot(snapshot["station_id_translator"]),
+        TrainTypeTranslator(ailas=True).from_snapshot(snapshot["train_type_translator"]),
+    )
+
+
+def load_snapshot_tables(train_date):
+    snapshot = load_snapshot(train_date)
+    return None if snapshot is None else snapshot_tables(snapshot)
 
 
 class ResourceProvider:
-    def __init__(self, requester):
+    def __init__(
+        self,
+        requester,
+        derive_station_table=(
+            config.derive_station_table
+            if hasattr(config, "derive_station_table")
+            else False
+        ),  # 只下載列車時刻表，車站時刻表由本機反轉產生
+    ):
         self._requester = requester
+        self.derive_station_table = derive_station_table
         self.station_table = None
         self.station_table_tomorrow = None
         self.train_table = None
@@ -19,13 +78,123 @@ class ResourceProvider:
         self.station_id_translator = None
         self.train_type_translator = None
         self.station_live_table = None
+        self.generation = 0  # 每次 station_live_table 更新或重建時遞增
+        self.generation_event = asyncio.Event()  # 新的 generation 發布時設定，並換成新的
+        self.generation_slot = time.time()  # 目前 generation 對應的更新時間點，用來計算監視器延遲
+        self.tasks = []  # 背景工作要保留參照，否則可能在執行中被回收
+        self.train_date = None
 
     async def fetch_init(self):
-        await self.fetch_daily()
-        await self.fetch_live()
+        # 有今日快照時先以快照提供服務，再於背景向 TDX 重新取得
+        if await self.load_snapshot(service_date().strftime("%Y-%m-%d")):
+            await self.fetch_live()
+            self.tasks.append(asyncio.create_task(self.revalidate()))
+        else:
+            await self.fetch_daily()
+            await self.fetch_live()
         return self
 
+    def start(self):
+        # 定期更新時刻表與列車動態
+        self.tasks += [
+            asyncio.create_task(run_daily(daily_at, self.fetch_daily)),
+            asyncio.create_task(run_every(live_interval, self.fetch_live)),
+        ]
+        return self
+
+    def publish_generation(self, slot=None):
+        self.generation += 1
+        self.generation_slot = time.time() if slot is None else slot
+        live_generation.set(self.generation)
+        # 喚醒所有等待者，之後等待的則使用新的 Event
+        event, self.generation_event = self.generation_event, asyncio.Event()
+        event.set()
+
+    async def wait_generation(self, generation):
+        # 等到比 generation 新的資料發布後回傳最新的 generation，中間的版本會被合併
+        while self.generation <= generation:
+            await self.generation_event.wait()
+        return self.generation
+
+    async def revalidate(self):
+        try:
+            await self.fetch_daily()
+        except Exception as e:
+            logger.error(f"Failed to revalidate snapshot: {e}")
+
+    def to_snapshot(self):
+        return {
+            "station_table": self.station_table.to_snapshot(),
+            "station_table_tomorrow": self.station_table_tomorrow.to_snapshot(),
+            "train_table": self.train_table.to_snapshot(),
+            "train_table_tomorrow": self.train_table_tomorrow.to_snapshot(),
+            "station_id_translator": self.station_id_translator.to_snapshot(),
+            "train_type_translator": self.train_type_translator.to_snapshot(),
+        }
+
+    async def load_snapshot(self, train_date):
+        # 讀檔與重建物件約需數百毫秒，在執行緒中進行，不阻塞 Discord gateway
+        tables = await asyncio.to_thread(load_snapshot_tables, train_date)
+        if tables is None:
+            return False
+        self.apply_tables(train_date, tables)
+        return True
+
+    def apply_tables(self, train_date, tables):
+        self.train_date = train_date
+        (
+            self.station_table,
+            self.station_table_tomorrow,
+            self.train_table,
+            self.train_table_tomorrow,
+            self.station_id_translator,
+            self.train_type_translator,
+        ) = tables
+        self.rebuild_live()
+
+    async def save_snapshot(self):
+        try:
+            snapshot = self.to_snapshot()
+            await asyncio.to_thread(save_snapshot, self.train_date, snapshot)
+        except Exception as e:
+            logger.warning(f"Failed to save snapshot: {e}")
+
     async def fetch_daily(self):
+        train_date = service_date().strftime("%Y-%m-%d")
+        with fetch_seconds.time(kind="daily"):
+            try:
+                if self.derive_station_table:
+                    await self.fetch_derived_tables()
+                else:
+                    await self.fetch_all_tables()
+            except Exception:
+                fetch_errors.inc(kind="daily")
+                raise
+        self.train_date = train_date
+        self.rebuild_live()
+        await self.save_snapshot()
+        return self
+
+    async def fetch_derived_tables(self):
+        today, tomorrow = service_dates()
+        (
+            self.train_table,
+            self.train_table_tomorrow,
+            self.station_id_translator,
+            self.train_type_translator,
+        ) = await asyncio.gather(
+            TrainTable(today).fetch(self._requester),
+            TrainTable(tomorrow).fetch(self._requester),
+            StationTrainslator().fetch(self._requester),
+            TrainTypeTranslator(ailas=True).fetch(self._requester),
+        )
+        self.station_table = StationTable(today).from_train_table(self.train_table)
+        self.station_table_tomorrow = StationTable(
+            self.train_table_tomorrow.date
+        ).from_train_table(self.train_table_tomorrow)
+
+    async def fetch_all_tables(self):
+        today, tomorrow = service_dates()
         (
             self.station_table,
             self.station_table_tomorrow,
@@ -34,22 +203,65 @@ class ResourceProvider:
             self.station_id_translator,
             self.train_type_translator,
         ) = await asyncio.gather(
-                StationTable().fetch(self._requester),
-                StationTable(
-                    (datetime.now() + timedelta(days=1)).strftime("%Y-%m-%d"),
-                ).fetch(self._requester),
-                TrainTable().fetch(self._requester),
-                TrainTable(
-                    (datetime.now() + timedelta(days=1)).strftime("%Y-%m-%d"),
-                ).fetch(self._requester),
+                StationTable(today).fetch(self._requester),
+                StationTable(tomorrow).fetch(self._requester),
+                TrainTable(today).fetch(self._requester),
+                TrainTable(tomorrow).fetch(self._requester),
                 StationTrainslator().fetch(self._requester),
                 TrainTypeTranslator(ailas=True).fetch(self._requester),
         )
-        return self
+
+    def rebuild_live(self):
+        self.station_table.apply_overnight(self.train_table)
+        self.station_table_tomorrow.apply_overnight(self.train_table_tomorrow)
+        # 時刻表更新後需要重建，之後的動態更新才能以差異方式套用
+        if self.train_live is not None:
+            with live_table_seconds.time(operation="rebuild"):
+                station_live_table = StationLiveTable(
+                    self.station_table, self.station_table_tomorrow, self.train_live
+                )
+                # 預先建立舊表中已被讀取過的車站
+                if self.station_live_table is not None:
+                    station_live_table.prewarm(self.station_live_table.table.keys())
+            self.station_live_table = station_live_table
+            self.publish_generation()
 
     async def fetch_live(self):
-        self.train_live = await TrainPositionTable().fetch(self._requester)
-        self.station_live_table = StationLiveTable(
-            self.station_table, self.station_table_tomorrow, self.train_live
-        )
-        return self
\ No newline at end of file
+        # 排程在更新時間點呼叫，延遲從開始取得時算起，包含下載與套用的時間
+        slot = time.time()
+        with fetch_seconds.time(kind="live"):
+            try:
+                train_live = await TrainPositionTable().fetch(
+                    self._requester, conditional=self.train_live is not None
+                )
+            except Exception:
+                fetch_errors.inc(kind="live")
+                raise
+        self.apply_live(train_live, slot)
+        train_live.commit(self._requester)
+        return self
+
+    def apply_live(self, train_live, slot=None):
+        if train_live.unchanged:
+            # 資料沒有更新，略過解析與重建
+            if self.station_live_table is not None:
+                with live_table_seconds.time(operation="tick"):
+                    self.station_live_table.tick()
+                self.publish_generation(slot)
+            return
+        self.train_live = train_live
+        live_trains.set(len(train_live.table))
+        if self.station_live_table is None:
+            with live_table_seconds.time(operation="build"):
+                self.station_live_table = StationLiveTable(
+                    self.station_table, self.station_table_tomorrow, self.train_live
+                )
+        else:
+            with live_table_seconds.time(operation="update"):
+                self.station_live_table.update(self.train_live)
+        self.publish_generation(slot)
+
+    async def close(self):
+        for task in self.tasks:
+            task.cancel()
+        await self._requester.close()
@@ -0,0 +1,50 @@
+# 以 asyncio 工作定時執行，對齊整點的秒數或每日的固定時間
+
+import asyncio
+import logging
+import time
+from datetime import datetime, timedelta
+
+logger = logging.getLogger(__name__)
+
+
+def seconds_until_next(interval, now=None):
+    # 對齊整點的 interval 秒，例如 20 秒即 :00/:20/:40
+    now = time.time() if now is None else now
+    return interval - now % interval
+
+
+def seconds_until(at, now=None):
+    now = datetime.now() if now is None else now
+    hour, minute = map(int, at.split(":"))
+    next_run = now.replace(hour=hour, minute=minute, second=0, microsecond=0)
+    if next_run <= now:
+        next_run += timedelta(days=1)
+    return (next_run - now).total_seconds()
+
+
+async def run_job(job):
+    try:
+        await job()
+    except Exception as e:
+        logger.error(f"Scheduled job {job.__qualname__} failed: {e}")
+
+
+async def run_every(interval, job):
+    # 以目標時間推進，sleep 提早醒來也不會在同一個時間點執行兩次
+    target = time.time() + seconds_until_next(interval)
+    while True:
+        await asyncio.sleep(max(0, target - time.time()))
+        await run_job(job)
+        target += interval
+        # 工作超過一個間隔時略過錯過的時間點
+        while target <= time.time():
+            target += interval
+
+
+async def run_daily(at, job):
+    target = datetime.now() + timedelta(seconds=seconds_until(at))
+    while True:
+        await asyncio.sleep(max(0, (target - datetime.now()).total_seconds()))
+        await run_job(job)
+        target += timedelta(days=1)
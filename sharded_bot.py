@@ -0,0 +1,279 @@
+# 分片執行：由一個程序向 TDX 取得資料並發布到共享記憶體，
+# 其餘程序從同一個區段解出各自的一份資料，各自負責部分 Discord 分片與監視器
+
+import asyncio
+import logging
+import marshal
+import multiprocessing
+import multiprocessing.connection
+import os
+from multiprocessing import resource_tracker
+from multiprocessing.shared_memory import SharedMemory
+
+import config
+import metrics
+from resource_provider import ResourceProvider, daily_at, live_interval, snapshot_tables
+from scheduler import run_daily, run_every
+from snapshot import SNAPSHOT_MAGIC
+from station_live import service_date
+from tdx_requester import TDXRequester
+from train_live import TrainPositionTable
+
+logger = logging.getLogger(__name__)
+
+shard_workers = config.shard_workers if hasattr(config, "shard_workers") else 2
+shard_count = config.shard_count if hasattr(config, "shard_count") else shard_workers
+
+
+def publish_segment(data):
+    # 沿用本機快照的 marshal 格式，前面加上相同的版本標頭
+    payload = SNAPSHOT_MAGIC + marshal.dumps(data)
+    segment = SharedMemory(create=True, size=len(payload))
+    segment.buf[: len(payload)] = payload
+    return segment, len(payload)
+
+
+def attach_segment(name):
+    # 由發布端負責釋放，讀取端不向 resource tracker 登記 (Python 3.13+)
+    try:
+        return SharedMemory(name=name, track=False)
+    except TypeError:
+        segment = SharedMemory(name=name)
+    # 舊版 Python 開啟時一定會登記，程序結束時 tracker 會釋放發布端仍在使用的區段
+    resource_tracker.unregister(segment._name, "shared_memory")
+    return segment
+
+
+def read_segment(name, size):
+    # 共享的只有序列化後的位元組，marshal.loads 會在每個程序建立各自的物件
+    segment = attach_segment(name)
+    try:
+        with segment.buf[:size].toreadonly() as view:
+            if view[: len(SNAPSHOT_MAGIC)] != SNAPSHOT_MAGIC:
+                raise ValueError(f"Incompatible segment {name}")
+            with view[len(SNAPSHOT_MAGIC) :] as payload:
+                return marshal.loads(payload)
+    finally:
+        segment.close()
+
+
+def read_daily_segment(name, size):
+    train_date, snapshot = read_segment(name, size)
+    return train_date, snapshot_tables(snapshot)
+
+
+class SnapshotPublisher:
+    # 每次更新建立新的共享記憶體區段，保留上一版給還沒讀完的程序
+    keep = 2
+
+    def __init__(self, resource_provider: ResourceProvider, connections):
+        self.resource_provider = resource_provider
+        self.connections = connections
+        self.segments = {"daily": [], "live": []}
+        self.tasks = []
+
+    def publish(self, kind, data):
+        segment, size = publish_segment(data)
+        self.segments[kind].append(segment)
+        self.notify((kind, segment.name, size, self.resource_provider.generation_slot))
+        while len(self.segments[kind]) > self.keep:
+            old = self.segments[kind].pop(0)
+            old.close()
+            old.unlink()
+
+    def notify(self, message):
+        for connection in self.connections:
+            try:
+                connection.send(message)
+            except (BrokenPipeError, OSError) as e:
+                logger.warning(f"Failed to notify worker: {e}")
+
+    def publish_daily(self):
+        self.publish(
+            "daily", (self.resource_provider.train_date, self.resource_provider.to_snapshot())
+        )
+
+    def publish_live(self, train_live):
+        if train_live is None:
+            return
+        self.publish("live", train_live.to_snapshot())
+
+    async def fetch_init(self):
+        # 與 ResourceProvider.fetch_init 相同，但背景重新取得的結果也要發布
+        today = service_date().strftime("%Y-%m-%d")
+        if await self.resource_provider.load_snapshot(today):
+            await self.resource_provider.fetch_live()
+            self.tasks.append(asyncio.create_task(self.fetch_daily()))
+        else:
+            await self.resource_provider.fetch_daily()
+            await self.resource_provider.fetch_live()
+        self.publish_daily()
+        self.publish_live(self.resource_provider.train_live)
+
+    async def fetch_daily(self):
+        try:
+            await self.resource_provider.fetch_daily()
+        except Exception as e:
+            logger.error(f"Failed to fetch daily data: {e}")
+            return
+        self.publish_daily()
+
+    async def fetch_live(self):
+        train_live = self.resource_provider.train_live
+        try:
+            await self.resource_provider.fetch_live()
+        except Exception as e:
+            logger.error(f"Failed to fetch live data: {e}")
+            return
+        if self.resource_provider.train_live is train_live:
+            # 資料沒有更新，只通知各程序推進時間窗
+            self.notify(("tick", None, 0, self.resource_provider.generation_slot))
+        else:
+            self.publish_live(self.resource_provider.train_live)
+
+    def close(self):
+        for task in self.tasks:
+            task.cancel()
+        for connection in self.connections:
+            connection.close()
+        for segments in self.segments.values():
+            for segment in segments:
+                segment.close()
+                segment.unlink()
+            segments.clear()
+
+
+class SharedResourceProvider(ResourceProvider):
+    # 分片程序使用的資料來源，不直接連線 TDX，只套用發布端送來的快照
+    def __init__(self, connection):
+        super().__init__(requester=None)
+        self.connection = connection
+        self.ready = asyncio.Event()
+
+    async def fetch_init(self):
+        self.tasks.append(asyncio.create_task(self.listen()))
+        await self.ready.wait()
+        return self
+
+    def start(self):
+        # 更新由發布端推送，不需要自己的排程
+        return self
+
+    async def listen(self):
+        while True:
+            try:
+                kind, name, size, slot = await asyncio.to_thread(self.connection.recv)
+            except EOFError:
+                logger.error("Snapshot publisher exited")
+                return
+            try:
+                await self.apply_message(kind, name, size, slot)
+            except FileNotFoundError:
+                # 區段已被更新的版本取代並釋放，等待下一則通知
+                logger.warning(f"Skipped expired {kind} segment {name}")
+            except Exception as e:
+                logger.error(f"Failed to apply {kind} segment {name}: {e}")
+
+    async def apply_message(self, kind, name, size, slot):
+        # slot 是發布端開始取得這一版的時間，監視器延遲與單程序模式一樣從更新時間點算起
+        if kind == "daily":
+            # 解出每日時刻表較慢，在執行緒中進行，不阻塞本程序的分片
+            train_date, tables = await asyncio.to_thread(read_daily_segment, name, size)
+            self.apply_tables(train_date, tables)
+        elif kind == "live":
+            if self.station_table is None:
+                return
+            self.apply_live(TrainPositionTable().from_snapshot(read_segment(name, size)), slot)
+            self.ready.set()
+        elif kind == "tick":
+            if self.train_live is None:
+                return
+            train_live = TrainPositionTable()
+            train_live.unchanged = True
+            self.apply_live(train_live, slot)
+
+    async def fetch_daily(self):
+        return self
+
+    async def fetch_live(self):
+        return self
+
+    async def close(self):
+        for task in self.tasks:
+            task.cancel()
+        self.connection.close()
+
+
+def run_worker(index, shard_ids, total_shards, connection):
+    # discord_bot 在匯入時依環境變數建立分片機器人，因此要先設定再匯入
+    os.environ["DBOTDX_SHARD_IDS"] = ",".join(map(str, shard_ids))
+    os.environ["DBOTDX_SHARD_COUNT"] = str(total_shards)
+    # 發布端使用 metrics_port，各分片程序依序往後
+    if metrics.metrics_port is not None:
+        os.environ["DBOTDX_METRICS_PORT"] = str(metrics.metrics_port + 1 + index)
+    import discord_bot
+
+    async def create_resource_provider():
+        return await SharedResourceProvider(connection).fetch_init()
+
+    discord_bot.create_resource_provider = create_resource_provider
+    discord_bot.bot.run(config.bot_token)
+
+
+def start_workers(context):
+    workers = []
+    connections = []
+    for index in range(shard_workers):
+        shard_ids = list(range(index, shard_count, shard_workers))
+        if not shard_ids:
+            continue
+        receiver, sender = context.Pipe(duplex=False)
+        worker = context.Process(
+            target=run_worker,
+            args=(index, shard_ids, shard_count, receiver),
+            name=f"shard-worker-{index}",
+            daemon=True,
+        )
+        worker.start()
+        receiver.close()
+        workers.append(worker)
+        connections.append(sender)
+    return workers, connections
+
+
+async def main():
+    logging.basicConfig(
+        format="%(asctime)s - %(processName)s - %(levelname)s - %(message)s",
+        level=logging.INFO,
+    )
+    # 子程序各自建立事件迴圈，不能沿用 fork 的狀態
+    workers, connections = start_workers(multiprocessing.get_context("spawn"))
+    requester = TDXRequester()
+    publisher = SnapshotPublisher(ResourceProvider(requester), connections)
+    metrics_runner = None
+    if metrics.metrics_port is not None:
+        metrics_runner = await metrics.start_server()
+    try:
+        await publisher.fetch_init()
+        tasks = [
+            asyncio.create_task(run_daily(daily_at, publisher.fetch_daily)),
+            asyncio.create_task(run_every(live_interval, publisher.fetch_live)),
+        ]
+        sentinels = [worker.sentinel for worker in workers]
+        while sentinels:
+            ready = await asyncio.to_thread(multiprocessing.connection.wait, sentinels)
+            sentinels = [sentinel for sentinel in sentinels if sentinel not in ready]
+        logger.error("All shard workers exited")
+        for task in tasks:
+            task.cancel()
+    finally:
+        publisher.close()
+        await requester.close()
+        if metrics_runner is not None:
+            await metrics_runner.cleanup()
+        for worker in workers:
+            worker.terminate()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,59 @@
+# 將解析後的每日時刻表存成本機快照，重新啟動時可以直接載入，不必等待 TDX
+
+import logging
+import marshal
+import mmap
+import os
+import sys
+
+import config
+
+logger = logging.getLogger(__name__)
+
+snapshot_dir = config.snapshot_dir if hasattr(config, "snapshot_dir") else "snapshots"
+
+# 快照內容的格式版本，資料欄位有變動時遞增
+SNAPSHOT_VERSION = 2
+
+# marshal 的格式依 Python 版本而異，版本不同的快照直接忽略
+SNAPSHOT_MAGIC = b"DBTXSNAP" + bytes((SNAPSHOT_VERSION, *sys.version_info[:2]))
+
+
+def snapshot_path(train_date):
+    return os.path.join(snapshot_dir, f"{train_date}.snap")
+
+
+def save_snapshot(train_date, data):
+    os.makedirs(snapshot_dir, exist_ok=True)
+    path = snapshot_path(train_date)
+    temp_path = f"{path}.tmp"
+    with open(temp_path, "wb") as file:
+        file.write(SNAPSHOT_MAGIC)
+        marshal.dump(data, file)
+    os.replace(temp_path, path)
+    # 只保留最新一天的快照
+    for name in os.listdir(snapshot_dir):
+        if name.endswith(".snap") and name != os.path.basename(path):
+            os.remove(os.path.join(snapshot_dir, name))
+    logger.info(f"Saved snapshot {path}")
+
+
+def load_snapshot(train_date):
+    path = snapshot_path(train_date)
+    if not os.path.exists(path) or os.path.getsize(path) <= len(SNAPSHOT_MAGIC):
+        return None
+    # mmap 只省下一次讀檔複製，marshal.loads 仍會建立完整的物件，呼叫端應在執行緒中載入
+    try:
+        with open(path, "rb") as file, mmap.mmap(
+            file.fileno(), 0, access=mmap.ACCESS_READ
+        ) as mapped, memoryview(mapped) as view:
+            if view[: len(SNAPSHOT_MAGIC)] != SNAPSHOT_MAGIC:
+                logger.warning(f"Ignoring incompatible snapshot {path}")
+                return None
+            with view[len(SNAPSHOT_MAGIC) :] as payload:
+                data = marshal.loads(payload)
+    except (OSError, ValueError, EOFError, TypeError) as e:
+        logger.warning(f"Failed to load snapshot {path}: {e}")
+        return None
+    logger.info(f"Loaded snapshot {path}")
+    return data
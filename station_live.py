@@ -1,189 +1,253 @@
+from bisect import bisect_left, bisect_right, insort
 from datetime import datetime, timedelta
 
 import tdx_requester
-from station_table import StationTable, Train, Station
+from station_table import StationTable, Train, Station, minutes_to_time
 from train_live import TrainPositionTable
 
-def time_delay(original_time: str, delay: int) -> str:
-    original_time_obj = datetime.strptime(original_time, "%H:%M")
-    delayed_time_obj = original_time_obj + timedelta(minutes=delay)
-    return delayed_time_obj.strftime("%H:%M")
+# 營運日從凌晨 3 點開始，之前仍屬於前一個營運日，前一天的跨日班次才不會在午夜後消失
+SERVICE_DAY_CUTOVER = 3 * 60
 
-def time_passed(compare_time: str, day_cross=0) -> bool:
-    current_time_obj = datetime.now()
-    day_start = current_time_obj.replace(
-        hour=day_cross, minute=0, second=0, microsecond=0
-    )
-    # 如果當前時間在當天的00:00之前，則將day_start設置為前一天的00:00
-    # 這樣可以確保在跨日的情況下，當前時間仍然能夠正確比較
-    # 例如：當前時間是23:59，day_cross是0，則day_start會設置為前一天的00:00
-    # 這樣可以確保當前時間在比較時不會錯過當天的00:00
-    if current_time_obj < day_start:
-        day_start -= timedelta(days=1)
-
-    compare_time_obj = datetime.strptime(compare_time, "%H:%M")
-    compare_time_obj = compare_time_obj.replace(
-        year=current_time_obj.year,
-        month=current_time_obj.month,
-        day=current_time_obj.day,
-    )
 
-    if compare_time_obj < day_start:
-        compare_time_obj += timedelta(days=1)
+def service_date(now=None):
+    now = datetime.now() if now is None else now
+    return (now - timedelta(minutes=SERVICE_DAY_CUTOVER)).date()
 
-    return current_time_obj >= compare_time_obj
 
+def service_dates(now=None):
+    # 營運日與隔日的日期，營運日就是今天時為 None，沿用 Today 路徑
+    now = datetime.now() if now is None else now
+    today = service_date(now)
+    tomorrow = (today + timedelta(days=1)).strftime("%Y-%m-%d")
+    return (None if today == now.date() else today.strftime("%Y-%m-%d"), tomorrow)
 
-def handle_cross_day_time(compare_time: str) -> datetime:
-    current_time_obj = datetime.now()
-    day_start = datetime.now().replace(second=0, microsecond=0)
 
-    if current_time_obj <= day_start:
-        day_start -= timedelta(days=1)
+def current_minutes(now=None) -> int:
+    # 以營運日 00:00 起算的分鐘數，換日線之前加上一天，與跨日班次的時間一致
+    now = datetime.now() if now is None else now
+    minutes = now.hour * 60 + now.minute
+    if minutes < SERVICE_DAY_CUTOVER:
+        minutes += 24 * 60
+    return minutes
 
-    compare_time_obj = datetime.strptime(compare_time, "%H:%M")
-    compare_time_obj = compare_time_obj.replace(
-        year=current_time_obj.year,
-        month=current_time_obj.month,
-        day=current_time_obj.day,
-    )
 
-    if compare_time_obj <= day_start:
-        compare_time_obj += timedelta(days=1)
-
-    return compare_time_obj
+def departure_key(train_live) -> int:
+    return train_live.departure_key
 
 
 class TrainLive:
-    def __init__(self, train: Train, delay=None):
+    __slots__ = (
+        "train_no",
+        "train_type",
+        "dest",
+        "scheduled_arrival",
+        "scheduled_departure",
+        "delay",
+        "day",
+        "delayed_arrival_minutes",
+        "delayed_departure_minutes",
+        "departure_key",
+        "departed",
+    )
+
+    def __init__(self, train: Train, delay=None, day=0):
         self.train_no = train.train_no
         self.train_type = train.train_type
         self.dest = train.dest
         self.scheduled_arrival = train.arrival
         self.scheduled_departure = train.departure
         self.delay = delay
-        self.delayed_arrival = time_delay(
-            self.scheduled_arrival, 0 if delay is None else delay
-        )
-        self.delayed_departure = time_delay(
-            self.scheduled_departure, 0 if delay is None else delay
-        )
-        self.departed = (
-            False if self.delay is None else time_passed(self.delayed_departure, 3)
-        )  # 如果列車還在線上，則以3點為換日線，否則直接以現在時間為換日線
+        self.day = day  # 0 為今日班次，1 為明日班次
+        # 以營運日 00:00 起算的分鐘數，明日班次加上一天，作為排序與時間窗的依據
+        self.delayed_arrival_minutes = train.arrival_minutes + (delay or 0)
+        self.delayed_departure_minutes = train.departure_minutes + (delay or 0)
+        self.departure_key = self.delayed_departure_minutes + day * 24 * 60
+        # 延誤時間來自今日的列車動態，若顯示的是明日班次，代表今日的班次已經發車
+        self.departed = self.delay is not None and day > 0
+
+    @property
+    def delayed_arrival(self):
+        return minutes_to_time(self.delayed_arrival_minutes)
+
+    @property
+    def delayed_departure(self):
+        return minutes_to_time(self.delayed_departure_minutes)
 
     def __repr__(self):
         return self.train_no
 
 
 class StationLive:
-    def __init__(self, station_id, station:Station, station_tomorrow:Station, train_pos_table):
+    def __init__(
+        self,
+        station_id,
+        station: Station,
+        station_tomorrow: Station,
+        train_pos_table,
+        now=None,
+    ):
         self.station_id = station_id
-        self.train_lives = {}
-        self.train_lives_sorted = None
-        self.directions = {}
-        self.directions_sorted = {}
         self.station = station
         self.station_tomorrow = station_tomorrow
         self.train_pos_table = train_pos_table
-
-        for direction, station_direction in self.station.directions.items():
-            if not direction in self.directions:
-                self.directions[direction] = {}
-            for train_no, train in station_direction.items():
-                train_live = TrainLive(
-                    train,
-                    (
-                        None
-                        if not train_no in self.train_pos_table
-                        else self.train_pos_table[train_no].delay
-                    ),
-                )
-                if not time_passed(train_live.delayed_departure, 0):
-                    self.train_lives[train_no] = train_live
-                    self.directions[direction][train_no] = train_live
-        for (
-            direction,
-            station_direction,
-        ) in self.station_tomorrow.directions.items():
-            if not direction in self.directions:
-                self.directions[direction] = {}
-            for train_no, train in station_direction.items():
-                train_live = TrainLive(
-                    train,
-                    (
-                        None
-                        if not train_no in self.train_pos_table
-                        else self.train_pos_table[train_no].delay
-                    ),
-                )
-                if time_passed(train_live.delayed_departure, 0):
-                    self.train_lives[train_no] = train_live
-                    self.directions[direction][train_no] = train_live
-        for direction in self.directions.keys():
-            self.directions_sorted[direction] = sorted(
-                self.directions[direction].values(),
-                key=lambda s: handle_cross_day_time(s.delayed_departure),
-            )
-        self.train_lives_sorted = sorted(
-            self.train_lives.values(),
-            key=lambda s: handle_cross_day_time(s.delayed_departure),
+        self.now = current_minutes() if now is None else now
+        # 今明兩日所有班次，依 departure_key 排序，顯示時再依目前時間切出未來 24 小時
+        self.timeline = []
+        self.directions = {}
+        self.entries = {}  # train_no -> [(direction, TrainLive)]
+
+        for train_no in set(self.station.trains).union(self.station_tomorrow.trains):
+            for direction, train_live in self._build(train_no):
+                self.timeline.append(train_live)
+                self.directions[direction].append(train_live)
+        self.timeline.sort(key=departure_key)
+        for lives in self.directions.values():
+            lives.sort(key=departure_key)
+
+    def _build(self, train_no):
+        delay = (
+            None
+            if not train_no in self.train_pos_table
+            else self.train_pos_table[train_no].delay
         )
+        entries = []
+        for day, station in enumerate((self.station, self.station_tomorrow)):
+            for direction, station_direction in station.directions.items():
+                if not direction in self.directions:
+                    self.directions[direction] = []
+                if train_no in station_direction:
+                    entries.append(
+                        (direction, TrainLive(station_direction[train_no], delay, day))
+                    )
+        self.entries[train_no] = entries
+        return entries
+
+    def update(self, train_pos_table, train_nos):
+        # 只重算延誤或動態有變化的班次，並以二分搜尋調整其排序位置
+        self.train_pos_table = train_pos_table
+        for train_no in train_nos:
+            for direction, train_live in self.entries.pop(train_no, ()):
+                remove_sorted(self.timeline, train_live)
+                remove_sorted(self.directions[direction], train_live)
+            for direction, train_live in self._build(train_no):
+                insort(self.timeline, train_live, key=departure_key)
+                insort(self.directions[direction], train_live, key=departure_key)
+
+    def _window(self, lives):
+        start = bisect_right(lives, self.now, key=departure_key)
+        end = bisect_right(lives, self.now + 24 * 60, key=departure_key)
+        return lives[start:end]
+
+    def _lives(self, direction=None):
+        return {
+            train_live.train_no: train_live
+            for train_live in self.sorted(direction)
+        }
 
     def values(self, direction=None):
-        lives = self.train_lives if direction is None else self.directions[direction]
-        return lives.values()
+        return self._lives(direction).values()
 
     def items(self, direction=None):
-        lives = self.train_lives if direction is None else self.directions[direction]
-        return lives.items()
+        return self._lives(direction).items()
 
     def sorted(self, direction=None):
         lives_sorted = (
-            self.train_lives_sorted
-            if direction is None
-            else self.directions_sorted[direction]
+            self.timeline if direction is None else self.directions.get(direction, [])
         )
-        return lives_sorted
+        return self._window(lives_sorted)
 
     def __contains__(self, train_no, direction=None):
-        lives = self.train_lives if direction is None else self.directions[direction]
-        return train_no in lives
+        return train_no in self._lives(direction)
 
     def __getitem__(self, train_no, direction=None):
-        lives = self.train_lives if direction is None else self.directions[direction]
-        return lives[train_no]
+        return self._lives(direction)[train_no]
+
+
+def remove_sorted(lives, train_live):
+    index = bisect_left(lives, train_live.departure_key, key=departure_key)
+    while lives[index] is not train_live:
+        index += 1
+    del lives[index]
 
 
 class StationLiveTable:
-    def __init__(self, station_table:StationTable, tomorrow_station_table:StationTable, train_pos_table):
+    # 只在車站第一次被讀取時建立 StationLive，之後以動態差異保持最新
+    def __init__(self, station_table:StationTable, tomorrow_station_table:StationTable, train_pos_table, now=None):
         self.table = {}
         self.station_table = station_table
         self.tomorrow_station_table = tomorrow_station_table
         self.train_pos_table = train_pos_table
-        
-        for station_id in set(self.station_table.keys()).union(self.tomorrow_station_table.keys()):
-            self.table[station_id] = StationLive(
-                station_id,
-                self.station_table[station_id],
-                self.tomorrow_station_table[station_id],
-                self.train_pos_table,
-            )
+        self.now = current_minutes(now)  # 每次重建只取一次現在時間
+        self.generation = 0
+        self.train_stations = {}  # train_no -> {station_id}，只記錄已建立的車站
+
+    def materialize(self, station_id):
+        if station_id in self.table:
+            return self.table[station_id]
+        station_live = StationLive(
+            station_id,
+            self.station_table[station_id],
+            self.tomorrow_station_table[station_id],
+            self.train_pos_table,
+            self.now,
+        )
+        self.table[station_id] = station_live
+        for train_no in station_live.entries:
+            if train_no not in self.train_stations:
+                self.train_stations[train_no] = set()
+            self.train_stations[train_no].add(station_id)
+        return station_live
+
+    def prewarm(self, station_ids):
+        for station_id in station_ids:
+            if station_id in self:
+                self.materialize(station_id)
+        return self
+
+    def tick(self, now=None):
+        # 列車動態沒有變化時只推進時間窗
+        self.now = current_minutes(now)
+        self.generation += 1
+        for station_live in self.table.values():
+            station_live.now = self.now
+        return self
+
+    def update(self, train_pos_table, now=None):
+        changed = self.train_pos_table.diff(train_pos_table)
+        self.train_pos_table = train_pos_table
+        self.tick(now)
+        affected = {}
+        for train_no in changed:
+            for station_id in self.train_stations.get(train_no, ()):
+                if station_id not in affected:
+                    affected[station_id] = []
+                affected[station_id].append(train_no)
+        for station_live in self.table.values():
+            station_live.train_pos_table = train_pos_table
+        for station_id, train_nos in affected.items():
+            self.table[station_id].update(train_pos_table, train_nos)
+        return self
+
+    def station_ids(self):
+        return set(self.station_table.keys()).union(self.tomorrow_station_table.keys())
 
     def __contains__(self, station_id):
-        return station_id in self.table
+        return station_id in self.station_table or station_id in self.tomorrow_station_table
 
     def __getitem__(self, station_id):
-        return self.table[station_id]
+        if station_id not in self:
+            raise KeyError(station_id)
+        return self.materialize(station_id)
 
     def get(self, station_id):
-        return self.table[station_id]
+        return self[station_id]
 
     def values(self):
-        return self.table.values()
+        # 走訪全部車站時仍會建立所有車站
+        return [self.materialize(station_id) for station_id in self.station_ids()]
 
     def items(self):
-        return self.table.items()
+        return [(station_id, self.materialize(station_id)) for station_id in self.station_ids()]
 
 # 主函數，啟動異步請求並輸出各站時刻表
 async def main(station_id="1000"):
@@ -191,6 +255,7 @@ async def main(station_id="1000"):
     from train_type import TrainTypeTranslator
     
     requester = tdx_requester.TDXRequester()
+    today, tomorrow = service_dates()
 
     (
         station_table,
@@ -199,12 +264,13 @@ async def main(station_id="1000"):
         id_translator,
         type_translator,
     ) = await asyncio.gather(
-        StationTable().fetch(requester),
-        StationTable((datetime.now() + timedelta(days=1)).strftime("%Y-%m-%d")).fetch(requester),
+        StationTable(today).fetch(requester),
+        StationTable(tomorrow).fetch(requester),
         TrainPositionTable().fetch(requester),
         StationTrainslator().fetch(requester),
         TrainTypeTranslator(ailas=True).fetch(requester),
     )
+    await requester.close()
     station_live_table = StationLiveTable(
         station_table, station_table_tomorrow, train_pos_table
     )
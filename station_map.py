@@ -1,20 +1,72 @@
 import asyncio
+import unicodedata
+
 import tdx_requester
-import re
 
 query_path = "/v3/Rail/TRA/Station"
 query_args = "$select=StationID,StationName,StationClass"
 
-
-def check_input_type(input_str):
-    if re.fullmatch(r"\d+", input_str):
-        return "number"
-    elif re.fullmatch(r'[a-zA-Z\s\.,;!?\'"()\[\]{}:]+', input_str):
-        return "en"
-    elif re.fullmatch(r"[\u4e00-\u9fff]+", input_str):
-        return "zh"
-    else:
-        return "invalid"
+NAME_SUFFIXES = ("車站", "站", " station")
+# 英文站名比對時忽略空白、連字號與撇號，例如 Xin Zuoying 與 Xinzuoying
+COMPACT_TABLE = str.maketrans("", "", " -'’.")
+
+
+def normalize_name(name):
+    # 全形轉半形、台統一為臺、英文不分大小寫，並去掉「車站」「站」字尾
+    name = unicodedata.normalize("NFKC", name).strip().replace("台", "臺").casefold()
+    for suffix in NAME_SUFFIXES:
+        if name.endswith(suffix) and len(name) > len(suffix):
+            return name[: -len(suffix)]
+    return name
+
+
+def romanized_variants(name_en):
+    # 去掉聲調等附加符號 (Hanyu Pinyin 的 ā、ü 等)，另外加上不含空白的寫法
+    folded = "".join(
+        char
+        for char in unicodedata.normalize("NFKD", normalize_name(name_en))
+        if not unicodedata.combining(char)
+    )
+    return {folded, folded.translate(COMPACT_TABLE)}
+
+
+class StationSearchIndex:
+    # Discord autocomplete 最多 25 個選項
+    limit = 25
+
+    def __init__(self, station_namemap):
+        self.exact = {}  # 正規化後的完整名稱 -> station_id
+        self.prefixes = {}  # 前綴 -> [station_id]，依站等與代碼排序，最多 limit 個
+        for station_id in sorted(
+            station_namemap, key=lambda id: (station_namemap[id][2], id)
+        ):
+            name_zh, name_en, _ = station_namemap[station_id]
+            terms = {station_id, normalize_name(name_zh), *romanized_variants(name_en)}
+            for term in terms:
+                self.exact.setdefault(term, station_id)
+                for end in range(len(term) + 1):
+                    matches = self.prefixes.setdefault(term[:end], [])
+                    if len(matches) < self.limit and station_id not in matches:
+                        matches.append(station_id)
+
+    def search(self, query, limit=limit):
+        key = normalize_name(query)
+        matches = self.prefixes.get(key)
+        if matches is None:
+            matches = self.prefixes.get(key.translate(COMPACT_TABLE), [])
+        return matches[:limit]
+
+    def resolve(self, query):
+        # 完全相符優先，否則只有唯一一個前綴相符時才採用
+        key = normalize_name(query)
+        if key in self.exact:
+            return self.exact[key]
+        if key.translate(COMPACT_TABLE) in self.exact:
+            return self.exact[key.translate(COMPACT_TABLE)]
+        matches = self.search(query)
+        if len(matches) == 1:
+            return matches[0]
+        raise Exception(f"Search failed: {query}")
 
 def parse_station_data(data):
     station_namemap = {}
@@ -41,6 +93,8 @@ class StationTrainslator:
         self.station_namemap = None
         self.station_namemap_zh = None
         self.station_namemap_en = None
+        self.kinds = {}  # 代碼、中文或英文站名 -> 查詢類型
+        self.search_index = None
         self.lang = lang
         self.fetched = False
         self.parse(data) if data else None
@@ -49,6 +103,7 @@ class StationTrainslator:
         self.station_namemap, self.station_namemap_zh, self.station_namemap_en = (
             await fetch_station_data(requester)
         )
+        self.build_index()
         self.fetched = True
         return self
     
@@ -56,42 +111,50 @@ class StationTrainslator:
         self.station_namemap, self.station_namemap_zh, self.station_namemap_en = (
             parse_station_data(data)
         )
+        self.build_index()
+        self.fetched = True
+        return self
+
+    def to_snapshot(self):
+        self.assert_fetched()
+        return (self.station_namemap, self.station_namemap_zh, self.station_namemap_en)
+
+    def from_snapshot(self, snapshot):
+        self.station_namemap, self.station_namemap_zh, self.station_namemap_en = snapshot
+        self.build_index()
         self.fetched = True
         return self
 
+    def build_index(self):
+        # 每次更新站名表時建立一次，查詢時只需查字典
+        self.kinds = {}
+        for name in self.station_namemap_en:
+            self.kinds[name] = "en"
+        for name in self.station_namemap_zh:
+            self.kinds[name] = "zh"
+        for station_id in self.station_namemap:
+            self.kinds[station_id] = "number"
+        self.search_index = StationSearchIndex(self.station_namemap)
+
     def assert_fetched(self):
         if not self.fetched:
             raise Exception("Station map not fetched")
 
     def __contains__(self, id):
         self.assert_fetched()
-        itype = check_input_type(id)
-        if itype == "number":
-            return id in self.station_namemap
-        elif itype == "en":
-            return id in self.station_namemap_en
-        elif itype == "zh":
-            return id in self.station_namemap_zh
-        else:
-            return False
+        return id in self.kinds
 
     def __getitem__(self, id):
         self.assert_fetched()
-        itype = check_input_type(id)
+        itype = self.kinds.get(id)
         if itype == "number":
-            if id not in self.station_namemap:
-                raise Exception(f"Search failed: id={id}")
             return self.station_namemap[id][1 if self.lang == "en" else 0]
         elif itype == "en":
-            if id not in self.station_namemap_en:
-                raise Exception(f"Search failed: en={id}")
             return self.station_namemap_en[id]
         elif itype == "zh":
-            if id not in self.station_namemap_zh:
-                raise Exception(f"Search failed: zh={id}")
             return self.station_namemap_zh[id]
         else:
-            raise Exception(f"Invalid input: {id}")
+            raise Exception(f"Search failed: {id}")
 
     def id(self, id):
         self.assert_fetched()
@@ -104,6 +167,15 @@ class StationTrainslator:
         else:
             raise Exception(f"Search failed: id={id}")
 
+    def search(self, query, limit=StationSearchIndex.limit):
+        self.assert_fetched()
+        return self.search_index.search(query, limit)
+
+    def resolve(self, query):
+        # 接受代碼、中英文站名、前綴與台/臺等寫法，回傳 station_id
+        self.assert_fetched()
+        return self.search_index.resolve(query)
+
     def station_class(self, id):
         self.assert_fetched()
         if id in self.station_namemap:
@@ -119,6 +191,7 @@ class StationTrainslator:
 async def main():
     requester = tdx_requester.TDXRequester()
     translator = await StationTrainslator().fetch(requester)
+    await requester.close()
     
     for station_id, names in translator.items():
         print(
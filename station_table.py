@@ -1,23 +1,77 @@
 import asyncio
+from sys import intern
+
 import tdx_requester
 
 QUERY_PATH = "/v3/Rail/TRA/DailyStationTimetable/Today"
 QUERY_PATH_DATE = "/v3/Rail/TRA/DailyStationTimetable/TrainDate"
 QUERY_ARGS = "$select=StationID,Direction,TimeTables"
 
+
+def time_to_minutes(time_str: str) -> int:
+    hour, minute = time_str.split(":")
+    return int(hour) * 60 + int(minute)
+
+
+def minutes_to_time(minutes: int) -> str:
+    minutes %= 24 * 60
+    return f"{minutes // 60:02d}:{minutes % 60:02d}"
+
+
 class Train:
+    # 兩天的時刻表會有數十萬筆，使用 __slots__ 並共用重複的字串以節省記憶體
+    __slots__ = (
+        "train_no",
+        "arrival",
+        "departure",
+        "dest",
+        "train_type",
+        "train_level",
+        "arrival_minutes",
+        "departure_minutes",
+    )
+
     def __init__(self, train_data):
-        self.train_no = train_data["TrainNo"]
-        self.arrival = train_data["ArrivalTime"]
-        self.departure = train_data["DepartureTime"]
-        self.dest = train_data["DestinationStationID"]
-        self.train_type = train_data["TrainTypeID"]
-        self.train_level = train_data["TrainTypeCode"]
+        self.train_no = intern(train_data["TrainNo"])
+        self.arrival = intern(train_data["ArrivalTime"])
+        self.departure = intern(train_data["DepartureTime"])
+        self.dest = intern(train_data["DestinationStationID"])
+        self.train_type = intern(train_data["TrainTypeID"])
+        self.train_level = intern(train_data["TrainTypeCode"])
+        # 以營運日 00:00 起算的分鐘數，跨日班次由 StationTable.apply_overnight 補上一天
+        self.arrival_minutes = time_to_minutes(self.arrival)
+        self.departure_minutes = time_to_minutes(self.departure)
+
+    @classmethod
+    def from_stop(cls, train, stop):
+        # 由列車時刻表的停靠資料產生車站時刻表的班次
+        station_train = cls.__new__(cls)
+        station_train.train_no = train.train_no
+        station_train.arrival = stop.arrival
+        station_train.departure = stop.departure
+        station_train.dest = train.end_station_id
+        station_train.train_type = train.train_type_id
+        station_train.train_level = train.train_type_code
+        station_train.arrival_minutes = stop.arrival_minutes
+        station_train.departure_minutes = stop.departure_minutes
+        return station_train
+
+    def dump(self):
+        return tuple(getattr(self, name) for name in self.__slots__)
+
+    @classmethod
+    def load(cls, values):
+        train = cls.__new__(cls)
+        for name, value in zip(cls.__slots__, values):
+            setattr(train, name, value)
+        return train
 
     def __repr__(self):
         return self.train_no
 
 class Station:
+    __slots__ = ("station_id", "date", "trains", "directions")
+
     def __init__(self, station_id, date=None):
         self.station_id = station_id
         self.date = date
@@ -31,6 +85,25 @@ class Station:
             self.directions[direction] = {}
         self.directions[direction][train_no] = train
 
+    def dump(self):
+        return (
+            self.station_id,
+            self.date,
+            [
+                (direction, [train.dump() for train in trains.values()])
+                for direction, trains in self.directions.items()
+            ],
+        )
+
+    @classmethod
+    def load(cls, values):
+        station_id, date, directions = values
+        station = cls(station_id, date)
+        for direction, trains in directions:
+            for train in trains:
+                station.append(direction, Train.load(train))
+        return station
+
     def __repr__(self):
         return self.station_id
 
@@ -49,15 +122,15 @@ class Station:
 def parse_station_table(data,date):
     stations = {}
     for station_timetable in data["StationTimetables"]:
-        station_id = station_timetable["StationID"]
+        station_id = intern(station_timetable["StationID"])
         direction = station_timetable["Direction"]
 
         if station_id not in stations:
-            station = Station(station_id, date)
+            stations[station_id] = Station(station_id, date)
+        station = stations[station_id]
 
         for train_data in station_timetable["TimeTables"]:
             station.append(direction, Train(train_data))
-        stations[station_id] = station
     return stations
 
 async def fetch_station_table(requester, date=None):
@@ -81,7 +154,36 @@ class StationTable:
         return self
     
     def parse(self, data):
-        self.stations = parse_station_table(data)
+        self.stations = parse_station_table(data, data.get("TrainDate", self.date))
+        self.fetched = True
+        return self
+
+    def from_train_table(self, train_table):
+        # 反轉列車時刻表得到車站時刻表，只需走訪一次所有停靠
+        self.stations = {}
+        for train in train_table.values():
+            # 終點站沒有發車，與車站時刻表一樣不列入
+            for stop in list(train.stop_table.values())[:-1]:
+                if stop.station_id not in self.stations:
+                    self.stations[stop.station_id] = Station(
+                        stop.station_id, train_table.date
+                    )
+                self.stations[stop.station_id].append(
+                    train.direction, Train.from_stop(train, stop)
+                )
+        self.fetched = True
+        return self
+
+    def to_snapshot(self):
+        self.assert_fetched()
+        return (self.date, [station.dump() for station in self.stations.values()])
+
+    def from_snapshot(self, snapshot):
+        self.date, stations = snapshot
+        self.stations = {}
+        for values in stations:
+            station = Station.load(values)
+            self.stations[station.station_id] = station
         self.fetched = True
         return self
 
@@ -97,6 +199,19 @@ class StationTable:
         self.assert_fetched()
         return Station(station_id) if not self.__contains__(station_id) else self.stations[station_id]
 
+    def apply_overnight(self, train_table):
+        # 車站時刻表沒有跨日資訊，以列車時刻表的停靠時間補上跨日偏移
+        self.assert_fetched()
+        for train in train_table.values():
+            if train.overnight_id is None:
+                continue
+            for stop in train.stop_table.values():
+                if stop.station_id in self.stations and train.train_no in self.stations[stop.station_id]:
+                    station_train = self.stations[stop.station_id][train.train_no]
+                    station_train.arrival_minutes = stop.arrival_minutes
+                    station_train.departure_minutes = stop.departure_minutes
+        return self
+
     def stops(self, station_id, train_no):
         self.assert_fetched()
         return train_no in self[station_id].trains
@@ -116,6 +231,7 @@ class StationTable:
 async def main():
     requester = tdx_requester.TDXRequester()
     table = await StationTable().fetch(requester)
+    await requester.close()
     print("410" in table["0990"])
 
 if __name__ == "__main__":
@@ -0,0 +1,230 @@
+# 監視器任務存放在 SQLite，新增與刪除只寫入一筆，所有操作都在執行緒中進行，不阻塞事件迴圈
+
+import asyncio
+import json
+import logging
+import os
+import sqlite3
+import threading
+
+import config
+
+try:
+    import jsonschema
+except ImportError:
+    jsonschema = None
+
+logger = logging.getLogger(__name__)
+
+task_db_path = config.task_db_path if hasattr(config, "task_db_path") else "tasks.db"
+LEGACY_TASKS_PATH = "stored_tasks.json"
+SCHEMA_PATH = "schema.json"
+
+COLUMNS = (
+    "message_id",
+    "channel_id",
+    "guild_id",
+    "station_id",
+    "destination_id",
+    "direction",
+    "count",
+)
+
+JSON_TYPES = {
+    "integer": lambda value: isinstance(value, int) and not isinstance(value, bool),
+    "string": lambda value: isinstance(value, str),
+    "null": lambda value: value is None,
+    "object": lambda value: isinstance(value, dict),
+}
+
+
+class TaskValidationError(ValueError):
+    pass
+
+
+def load_task_schema(path=SCHEMA_PATH):
+    with open(path, "r", encoding="utf-8") as file:
+        schema = json.load(file)
+    return schema["definitions"]["station_task"]
+
+
+def check_schema(task, schema):
+    # 沒有安裝 jsonschema 時，只檢查 schema.json 用到的 type/required/additionalProperties
+    if not isinstance(task, dict):
+        raise TaskValidationError("Task must be an object")
+    for name in schema.get("required", ()):
+        if name not in task:
+            raise TaskValidationError(f"Missing required property: {name}")
+    properties = schema.get("properties", {})
+    for name, value in task.items():
+        if name not in properties:
+            if schema.get("additionalProperties", True) is False:
+                raise TaskValidationError(f"Unexpected property: {name}")
+            continue
+        types = properties[name].get("type")
+        if types is None:
+            continue
+        types = [types] if isinstance(types, str) else types
+        if not any(JSON_TYPES[json_type](value) for json_type in types):
+            raise TaskValidationError(f"Invalid type for {name}: {value!r}")
+
+
+def validate_task(task, schema):
+    if jsonschema is None:
+        check_schema(task, schema)
+        return
+    try:
+        jsonschema.validate(task, schema)
+    except jsonschema.ValidationError as e:
+        raise TaskValidationError(e.message) from e
+
+
+def normalize_task(task):
+    # Discord 的 ID 以整數存放，舊檔案中可能是字串
+    task = {name: task.get(name) for name in COLUMNS}
+    task["message_id"] = int(task["message_id"])
+    task["channel_id"] = int(task["channel_id"])
+    if task["guild_id"] is not None:
+        task["guild_id"] = int(task["guild_id"])
+    return task
+
+
+class TaskStore:
+    def __init__(self, path=task_db_path, schema_path=SCHEMA_PATH):
+        self.path = path
+        self.schema = load_task_schema(schema_path)
+        self.connection = None
+        self.lock = threading.Lock()  # 同一個連線會在不同執行緒中使用
+
+    async def open(self):
+        await asyncio.to_thread(self._open)
+        return self
+
+    def _open(self):
+        self.connection = sqlite3.connect(
+            self.path, timeout=30, check_same_thread=False, isolation_level=None
+        )
+        self.connection.row_factory = sqlite3.Row
+        with self.lock:
+            # 多個分片程序可能同時開啟同一個資料庫
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute("PRAGMA synchronous=NORMAL")
+            self.connection.execute(
+                """
+                CREATE TABLE IF NOT EXISTS station_tasks (
+                    message_id INTEGER PRIMARY KEY,
+                    channel_id INTEGER NOT NULL,
+                    guild_id INTEGER,
+                    station_id TEXT NOT NULL,
+                    destination_id TEXT,
+                    direction INTEGER,
+                    count INTEGER NOT NULL
+                )
+                """
+            )
+            self.connection.execute(
+                "CREATE INDEX IF NOT EXISTS station_tasks_station_id"
+                " ON station_tasks (station_id)"
+            )
+            self._add_guild_id()
+            self._migrate()
+
+    def _add_guild_id(self):
+        # 舊的資料庫沒有 guild_id，既有任務為 NULL，由分片 0 負責
+        columns = {
+            row["name"]
+            for row in self.connection.execute("PRAGMA table_info(station_tasks)")
+        }
+        if "guild_id" not in columns:
+            try:
+                self.connection.execute("ALTER TABLE station_tasks ADD COLUMN guild_id INTEGER")
+            except sqlite3.OperationalError:
+                # 其他分片程序已經加上
+                pass
+
+    def _migrate(self):
+        # 匯入舊版的 stored_tasks.json，完成後改名保留，不再讀取
+        if not os.path.exists(LEGACY_TASKS_PATH):
+            return
+        try:
+            with open(LEGACY_TASKS_PATH, "r", encoding="utf-8") as file:
+                data = json.load(file)
+        except (OSError, json.JSONDecodeError) as e:
+            logger.warning(f"Failed to read {LEGACY_TASKS_PATH}: {e}")
+            return
+        tasks = []
+        for task in data.get("tasks", {}).get("station", {}).values():
+            try:
+                validate_task(task, self.schema)
+                tasks.append(normalize_task(task))
+            except (TaskValidationError, TypeError, ValueError) as e:
+                logger.warning(f"Skipping invalid task {task}: {e}")
+        with self.connection:
+            self.connection.execute("BEGIN IMMEDIATE")
+            self.connection.executemany(self.upsert_sql(), tasks)
+        try:
+            os.replace(LEGACY_TASKS_PATH, f"{LEGACY_TASKS_PATH}.migrated")
+        except FileNotFoundError:
+            # 其他分片程序已經完成匯入
+            return
+        logger.info(f"Migrated {len(tasks)} tasks from {LEGACY_TASKS_PATH}")
+
+    def upsert_sql(self):
+        return (
+            f"INSERT OR REPLACE INTO station_tasks ({', '.join(COLUMNS)})"
+            f" VALUES ({', '.join(':' + name for name in COLUMNS)})"
+        )
+
+    def execute(self, sql, parameters=()):
+        with self.lock:
+            return self.connection.execute(sql, parameters).fetchall()
+
+    async def insert(self, task):
+        validate_task(task, self.schema)
+        await asyncio.to_thread(self.execute, self.upsert_sql(), normalize_task(task))
+
+    async def update(self, message_id, **fields):
+        task = await self.get(message_id)
+        if task is None:
+            raise KeyError(message_id)
+        task.update(fields)
+        await self.insert(task)
+        return task
+
+    async def delete(self, message_id):
+        await asyncio.to_thread(
+            self.execute,
+            "DELETE FROM station_tasks WHERE message_id = ?",
+            (int(message_id),),
+        )
+
+    async def get(self, message_id):
+        rows = await asyncio.to_thread(
+            self.execute,
+            "SELECT * FROM station_tasks WHERE message_id = ?",
+            (int(message_id),),
+        )
+        return dict(rows[0]) if rows else None
+
+    async def all(self):
+        rows = await asyncio.to_thread(self.execute, "SELECT * FROM station_tasks")
+        return [dict(row) for row in rows]
+
+    async def by_station(self, station_id):
+        rows = await asyncio.to_thread(
+            self.execute,
+            "SELECT * FROM station_tasks WHERE station_id = ?",
+            (station_id,),
+        )
+        return [dict(row) for row in rows]
+
+    async def station_ids(self):
+        rows = await asyncio.to_thread(
+            self.execute, "SELECT DISTINCT station_id FROM station_tasks"
+        )
+        return {row["station_id"] for row in rows}
+
+    async def close(self):
+        if self.connection is not None:
+            await asyncio.to_thread(self.connection.close)
+            self.connection = None
@@ -1,12 +1,23 @@
 import asyncio
-import flask
+import gzip
+import hashlib
 import logging
-import schedule
-from datetime import datetime, timedelta
-from flask import jsonify, redirect
+import re
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+from email.utils import format_datetime, parsedate_to_datetime
+from aiohttp import web
 
-from tdx_requester import TDXRequester
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+from tdx_requester import TDXRequester, UNCHANGED
+from scheduler import run_daily, run_every, seconds_until
 import config
+import metrics
 
 
 # Configuration
@@ -20,29 +31,216 @@ TRAIN_TABLE_PATH_DATE = "/v3/Rail/TRA/DailyTrainTimetable/TrainDate"
 TRAIN_LIVE_PATH = "/v3/Rail/TRA/TrainLiveBoard"
 TRAIN_LIVE_ARGS = "TrainNo,TrainTypeID,StationId,DelayTime"
 
-app = flask.Flask(__name__)
+# 其他路徑的讀取快取：依路徑前綴設定存活秒數，0 表示不快取、直接轉址
+DEFAULT_PROXY_TTLS = {
+    "/v3/Rail/TRA/TrainLiveBoard": 20,
+    "/v3/Rail/TRA/StationLiveBoard": 20,
+    "/v3/Rail/TRA/Alert": 60,
+    "/v3/Rail/TRA/DailyStationTimetable": 3600,
+    "/v3/Rail/TRA/DailyTrainTimetable": 3600,
+    "/v3/Rail/TRA/DailyTrainInfo": 3600,
+    "/v3/Rail/TRA/GeneralTrainTimetable": 86400,
+    "/v3/Rail/TRA/Station": 86400,
+    "/v3/Rail/TRA/Line": 86400,
+    "/v3/Rail/TRA/TrainType": 86400,
+}
+proxy_cache_ttls = (
+    config.relay_cache_ttls if hasattr(config, "relay_cache_ttls") else DEFAULT_PROXY_TTLS
+)
+proxy_cache_default_ttl = (
+    config.relay_cache_default_ttl if hasattr(config, "relay_cache_default_ttl") else 60
+)
+proxy_cache_max_bytes = (
+    config.relay_cache_max_bytes if hasattr(config, "relay_cache_max_bytes") else 64 << 20
+)
 
 # Set up logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+cache_requests = metrics.counter(
+    "relay_cache_requests_total",
+    "Requests served from the fixed cache (hit), the proxy cache (proxy_hit),"
+    " fetched upstream (proxy_miss), joined to an in-flight fetch (proxy_coalesced)"
+    " or redirected (redirect)",
+    ("route", "result"),
+)
+not_modified = metrics.counter(
+    "relay_not_modified_total", "Cache hits answered with 304", ("route",)
+)
+refresh_seconds = metrics.histogram(
+    "relay_refresh_seconds", "Time to refresh the cached payloads", ("kind",)
+)
+proxy_cache_bytes = metrics.gauge(
+    "relay_proxy_cache_bytes", "Bytes held by the proxy cache, including compressed copies"
+)
+proxy_cache_entries = metrics.gauge(
+    "relay_proxy_cache_entries", "Entries held by the proxy cache"
+)
+proxy_cache_evictions = metrics.counter(
+    "relay_proxy_cache_evictions_total", "Proxy cache entries evicted to stay under the byte limit"
+)
+
+
+def route_label(request):
+    return request.match_info.route.resource.canonical
+
+
+def accepted_encodings(header):
+    encodings = set()
+    for item in header.split(","):
+        encoding, _, params = item.partition(";")
+        quality = params.strip()
+        if quality.startswith("q="):
+            try:
+                if float(quality[2:]) == 0:
+                    continue
+            except ValueError:
+                continue
+        encodings.add(encoding.strip().lower())
+    return encodings
+
+
+# TDX 的回應開頭就是 UpdateTime/SrcUpdateTime，只掃描前段位元組，不解析整份 JSON
+HEADER_SCAN_BYTES = 512
+UPDATE_TIME_PATTERN = re.compile(rb'"(UpdateTime|SrcUpdateTime)"\s*:\s*"([^"]*)"')
+
+
+def payload_times(body):
+    return {
+        key.decode(): value.decode("utf-8", errors="replace")
+        for key, value in UPDATE_TIME_PATTERN.findall(body[:HEADER_SCAN_BYTES])
+    }
+
+
+def payload_version(times, body):
+    # 以資料本身的 UpdateTime/SrcUpdateTime 作為版本，沒有時以內容雜湊代替
+    if times:
+        version = f"{times.get('UpdateTime')}|{times.get('SrcUpdateTime')}".encode()
+    else:
+        version = body
+    return f'"{hashlib.blake2b(version, digest_size=12).hexdigest()}"'
+
+
+def payload_modified(times, upstream_modified=None):
+    for key in ("SrcUpdateTime", "UpdateTime"):
+        try:
+            return datetime.fromisoformat(times[key].replace("Z", "+00:00"))
+        except (KeyError, ValueError):
+            pass
+    if upstream_modified is not None:
+        try:
+            return parsedate_to_datetime(upstream_modified)
+        except (TypeError, ValueError):
+            pass
+    return datetime.now(timezone.utc)
+
+
+def variant_etag(etag, encoding=None):
+    # 各編碼的位元組不同，強 ETag 必須各自不同，以編碼名稱作為後綴
+    return etag if encoding is None else f'{etag[:-1]}-{encoding}"'
+
+
+class CachedPayload:
+    # 保存上游回應的原始位元組，每次更新時只壓縮一次，之後的請求直接回傳同一份位元組
+    def __init__(self, body, content_type=None, upstream_modified=None):
+        self.body = body
+        self.content_type = content_type or "application/json; charset=utf-8"
+        times = payload_times(body)
+        self.etag = payload_version(times, body)
+        modified = payload_modified(times, upstream_modified)
+        if modified.tzinfo is None:
+            modified = modified.replace(tzinfo=timezone.utc)
+        self.last_modified = modified.astimezone(timezone.utc).replace(microsecond=0)
+        self.encoded = {"gzip": gzip.compress(self.body, compresslevel=6)}
+        if brotli is not None:
+            self.encoded["br"] = brotli.compress(self.body, quality=5)
+        self.size = len(self.body) + sum(len(body) for body in self.encoded.values())
+        self.etags = {variant_etag(self.etag, encoding) for encoding in (None, *self.encoded)}
+
+    def not_modified(self, request):
+        if_none_match = request.headers.get("If-None-Match")
+        if if_none_match is not None:
+            etags = [etag.strip().removeprefix("W/") for etag in if_none_match.split(",")]
+            # If-None-Match 採弱比較，任一編碼的 ETag 都代表同一個版本
+            return "*" in etags or not self.etags.isdisjoint(etags)
+        if_modified_since = request.headers.get("If-Modified-Since")
+        if if_modified_since is not None:
+            try:
+                return self.last_modified <= parsedate_to_datetime(if_modified_since)
+            except (TypeError, ValueError):
+                return False
+        return False
+
+    def choose_encoding(self, request):
+        encodings = accepted_encodings(request.headers.get("Accept-Encoding", ""))
+        for encoding in ("br", "gzip"):
+            if encoding in encodings and encoding in self.encoded:
+                return encoding
+        return None
+
+    def response(self, request):
+        encoding = self.choose_encoding(request)
+        headers = {
+            "ETag": variant_etag(self.etag, encoding),
+            "Last-Modified": format_datetime(self.last_modified, usegmt=True),
+            "Vary": "Accept-Encoding",
+            "Content-Type": self.content_type,
+        }
+        if self.not_modified(request):
+            not_modified.inc(route=route_label(request))
+            return web.Response(status=304, headers=headers)
+        if encoding is None:
+            return web.Response(body=self.body, headers=headers)
+        headers["Content-Encoding"] = encoding
+        return web.Response(body=self.encoded[encoding], headers=headers)
+
+
+def cached_payload(response):
+    status, body, headers = response
+    if status != 200:
+        raise ValueError(f"Unexpected status: {status}")
+    return CachedPayload(body, headers.get("Content-Type"), headers.get("Last-Modified"))
+
 
 class CacheManager:
     def __init__(self, requester: TDXRequester):
         self.requester = requester
+        self.tomorrow = None
         self.station_map = None
         self.station_table_today = None
         self.station_table_tomorrow = None
         self.train_table_today = None
+        self.train_table_tomorrow = None
         self.train_live = None
 
     async def fetch_init(self):
         await asyncio.gather(self.fetch_daily(), self.fetch_live())
 
     async def fetch_daily(self):
-        station_table_tomorrow_path = f"{STATION_TABLE_PATH_DATE}/{(datetime.now() + timedelta(days=1)).strftime('%Y-%m-%d')}"
-        train_table_tomorrow_path = f"{TRAIN_TABLE_PATH_DATE}/{(datetime.now() + timedelta(days=1)).strftime('%Y-%m-%d')}"
+        with refresh_seconds.time(kind="daily"):
+            await self.refresh_daily()
+
+    async def refresh_daily(self):
+        tomorrow = (datetime.now() + timedelta(days=1)).strftime("%Y-%m-%d")
         try:
+            data = await asyncio.gather(
+                self.requester.get_raw(
+                    f"{STATION_MAP_PATH}?$select={STATION_MAP_ARGS}", no_relay=True
+                ),
+                self.requester.get_raw(
+                    f"{STATION_TABLE_TODAY_PATH}?$select={STATION_TABLE_ARGS}",
+                    no_relay=True,
+                ),
+                self.requester.get_raw(
+                    f"{STATION_TABLE_PATH_DATE}/{tomorrow}?$select={STATION_TABLE_ARGS}",
+                    no_relay=True,
+                ),
+                self.requester.get_raw(TRAIN_TABLE_TODAY_PATH, no_relay=True),
+                self.requester.get_raw(
+                    f"{TRAIN_TABLE_PATH_DATE}/{tomorrow}", no_relay=True
+                ),
+            )
             (
                 self.station_map,
                 self.station_table_today,
@@ -50,143 +248,230 @@ class CacheManager:
                 self.train_table_today,
                 self.train_table_tomorrow,
             ) = await asyncio.gather(
-                self.requester.get(
-                    f"{STATION_MAP_PATH}?{STATION_MAP_ARGS}", no_relay=True
-                ),
-                self.requester.get(
-                    f"{STATION_TABLE_TODAY_PATH}?{STATION_TABLE_ARGS}", no_relay=True
-                ),
-                self.requester.get(
-                    f"{station_table_tomorrow_path}?{STATION_TABLE_ARGS}",
-                    no_relay=True,
-                ),
-                self.requester.get(TRAIN_TABLE_TODAY_PATH, no_relay=True),
-                self.requester.get(train_table_tomorrow_path,no_relay=True),
-                
+                *[asyncio.to_thread(cached_payload, item) for item in data]
             )
+            self.tomorrow = tomorrow
             logger.debug("Daily data fetched successfully")
         except Exception as e:
-            logger.error(f"Error fetching daily data: {e}")            
+            logger.error(f"Error fetching daily data: {e}")
 
     async def fetch_live(self):
+        with refresh_seconds.time(kind="live"):
+            await self.refresh_live()
+
+    async def refresh_live(self):
+        subpath = f"{TRAIN_LIVE_PATH}?$select={TRAIN_LIVE_ARGS}"
         try:
-            self.train_live = await self.requester.get(
-                f"{TRAIN_LIVE_PATH}?{TRAIN_LIVE_ARGS}", no_relay=True
+            response = await self.requester.get_raw(
+                subpath,
+                no_relay=True,
+                conditional=self.train_live is not None,
             )
+            if response is UNCHANGED:
+                logger.debug("Live data unchanged")
+                return
+            self.train_live = await asyncio.to_thread(cached_payload, response)
+            self.requester.commit_validator(subpath)
             logger.debug("Live data fetched successfully")
         except Exception as e:
             logger.error(f"Error fetching live data: {e}")
 
 
-@app.route(STATION_MAP_PATH)
-def station_map():
-    args = flask.request.args
-    if (
-        len(args) == 2
-        and args["$select"] == STATION_MAP_ARGS
-        and '$format' in args and args["$format"] == "JSON"
-        and cache_manager.station_map is not None
-    ):
-        logger.info("Returning station map")
-        return jsonify(cache_manager.station_map)
-    return catch_all(f"{STATION_MAP_PATH}?{args.to_dict(flat=False)}")
-
-
-@app.route(STATION_TABLE_TODAY_PATH)
-def station_table():
-    args = flask.request.args
-    if (
-        len(args) == 2
-        and args["$select"] == STATION_TABLE_ARGS
-        and '$format' in args and args["$format"] == "JSON"
-        and cache_manager.station_table_today is not None
-    ):
-        return jsonify(cache_manager.station_table_today)
-    else:
-        return catch_all(f"{STATION_TABLE_TODAY_PATH}?{args.to_dict(flat=False)}")
-
-
-@app.route(f"{STATION_TABLE_PATH_DATE}<date>")
-def station_table_date(date):
-    args = flask.request.args
-    if (
-        len(args) == 1
-        and datetime.strptime(date, "%Y-%m-%d").strftime("%Y-%m-%d")
-        == (datetime.now() + timedelta(days=1)).strftime("%Y-%m-%d")
-        and args.get("$select") == STATION_TABLE_ARGS
-        and cache_manager.station_table_tomorrow is not None
-    ):
-        return jsonify(cache_manager.station_table_tomorrow)
-    else:
-        return catch_all(f"{STATION_TABLE_PATH_DATE}{date}?{args.to_dict(flat=False)}")
+def route_ttl(path, ttls=None):
+    # 取最長的相符前綴
+    ttls = proxy_cache_ttls if ttls is None else ttls
+    best = None
+    for prefix in ttls:
+        if path.startswith(prefix) and (best is None or len(prefix) > len(best)):
+            best = prefix
+    return proxy_cache_default_ttl if best is None else ttls[best]
 
 
-@app.route(TRAIN_TABLE_TODAY_PATH)
-def train_table():
-    if (
-        len(flask.request.args) == 0 
-        and cache_manager.train_table_today is not None
-    ):
-        return jsonify(cache_manager.train_table_today)
-    else:
-        return catch_all(f"{TRAIN_TABLE_TODAY_PATH}?{flask.request.args.to_dict(flat=False)}")
-    
-@app.route(f"{TRAIN_TABLE_PATH_DATE}<date>")
-def train_table_date(date):
-    args = flask.request.args
-    if (
-        len(args) == 1
-        and datetime.strptime(date, "%Y-%m-%d").strftime("%Y-%m-%d")
-        == (datetime.now() + timedelta(days=1)).strftime("%Y-%m-%d")
-        and args.get("$select") == STATION_TABLE_ARGS
-        and cache_manager.train_table_tomorrow is not None
-    ):
-        return jsonify(cache_manager.train_table_tomorrow)
-    else:
-        return catch_all(f"{TRAIN_TABLE_PATH_DATE}{date}?{args.to_dict(flat=False)}")
-
-
-@app.route(TRAIN_LIVE_PATH)
-def train_live():
-    args = flask.request.args
-    if (
-        len(args) == 1
-        and args.get("$select") == TRAIN_LIVE_ARGS
-        and cache_manager.train_live is not None
-    ):
-        return jsonify(cache_manager.train_live)
-    else:
-        return catch_all(f"{TRAIN_LIVE_PATH}?{args.to_dict(flat=False)}")
+def proxy_ttl(path, now=None):
+    # Today 路徑在午夜換成新的一天，快取不能跨過午夜
+    ttl = route_ttl(path)
+    if "/Today" in path:
+        ttl = min(ttl, seconds_until("00:00", now))
+    return ttl
 
 
-@app.route("/<path:path>")
-def catch_all(path):
-    return redirect(f"https://tdx.transportdata.tw/api/basic{path}", code=302)
+def cache_key(request):
+    # 參數順序不同或省略預設的 $format=JSON 都視為同一個查詢
+    path = request.path.rstrip("/") or "/"
+    query = sorted(
+        (key, value)
+        for key, value in request.query.items()
+        if not (key == "$format" and value.upper() == "JSON")
+    )
+    return (path, tuple(query))
 
 
-async def main():
-    global cache_manager
-    cache_manager = CacheManager(TDXRequester(api_root=config.tdx_api_root))
-    await cache_manager.fetch_init()
+class ProxyCache:
+    # 讀取快取：依存活時間失效，超過位元組上限時淘汰最久未使用的項目，同一個鍵同時只向上游請求一次
+    def __init__(self, requester: TDXRequester, max_bytes=proxy_cache_max_bytes):
+        self.requester = requester
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()  # key -> (expires, CachedPayload)
+        self.size = 0
+        self.inflight = {}
+
+    def lookup(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        expires, payload = entry
+        if expires <= time.monotonic():
+            self.remove(key)
+            return None
+        self.entries.move_to_end(key)
+        return payload
+
+    def store(self, key, payload, ttl):
+        if key in self.entries:
+            self.remove(key)
+        if payload.size > self.max_bytes:
+            return
+        self.entries[key] = (time.monotonic() + ttl, payload)
+        self.size += payload.size
+        while self.size > self.max_bytes:
+            self.remove(next(iter(self.entries)))
+            proxy_cache_evictions.inc()
+        self.update_metrics()
+
+    def remove(self, key):
+        _, payload = self.entries.pop(key)
+        self.size -= payload.size
+        self.update_metrics()
+
+    def update_metrics(self):
+        proxy_cache_bytes.set(self.size)
+        proxy_cache_entries.set(len(self.entries))
+
+    async def get(self, key, subpath, ttl):
+        # returns (payload, result)，只有實際向上游請求的才算 proxy_miss
+        payload = self.lookup(key)
+        if payload is not None:
+            return payload, "proxy_hit"
+        if key in self.inflight:
+            return await asyncio.shield(self.inflight[key]), "proxy_coalesced"
+        self.inflight[key] = asyncio.ensure_future(self.load(key, subpath, ttl))
+        self.inflight[key].add_done_callback(lambda _: self.inflight.pop(key, None))
+        return await asyncio.shield(self.inflight[key]), "proxy_miss"
+
+    async def load(self, key, subpath, ttl):
+        response = await self.requester.get_raw(subpath, no_relay=True)
+        payload = await asyncio.to_thread(cached_payload, response)
+        self.store(key, payload, ttl)
+        return payload
+
+
+def query_matches(request, select=None):
+    # 只接受與快取內容相同的查詢，$format 可省略
+    args = request.query
+    for key in args:
+        if key not in ("$select", "$format"):
+            return False
+    if args.get("$format", "JSON") != "JSON":
+        return False
+    return args.get("$select") == select
+
+
+async def serve(request, payload, select=None):
+    if payload is not None and query_matches(request, select):
+        cache_requests.inc(route=route_label(request), result="hit")
+        return payload.response(request)
+    return await proxy_upstream(request)
+
+
+async def station_map(request):
+    return await serve(request, cache_manager.station_map, STATION_MAP_ARGS)
 
-    def fetch_daily_task():
-        asyncio.run(cache_manager.fetch_daily())
 
-    def fetch_live_task():
-        asyncio.run(cache_manager.fetch_live())
+async def station_table(request):
+    return await serve(request, cache_manager.station_table_today, STATION_TABLE_ARGS)
 
-    # Schedule tasks
-    schedule.every().day.at("00:00").do(fetch_daily_task)
-    schedule.every(20).seconds.do(fetch_live_task)
 
-    # Run Flask app in a separate thread
-    loop = asyncio.get_event_loop()
-    loop.run_in_executor(None, app.run, None, config.tdx_relay_server_port, False)
+async def station_table_date(request):
+    if request.match_info["date"] != cache_manager.tomorrow:
+        return await proxy_upstream(request)
+    return await serve(
+        request, cache_manager.station_table_tomorrow, STATION_TABLE_ARGS
+    )
+
+
+async def train_table(request):
+    return await serve(request, cache_manager.train_table_today)
+
+
+async def train_table_date(request):
+    if request.match_info["date"] != cache_manager.tomorrow:
+        return await proxy_upstream(request)
+    return await serve(request, cache_manager.train_table_tomorrow)
+
+
+async def train_live(request):
+    return await serve(request, cache_manager.train_live, TRAIN_LIVE_ARGS)
+
+
+async def proxy_upstream(request):
+    # 由中繼站代為請求並快取，共用同一份上游額度；上游錯誤時才轉址讓客戶端自行取得
+    ttl = proxy_ttl(request.path)
+    if ttl <= 0:
+        redirect_upstream(request)
+    try:
+        payload, result = await proxy_cache.get(cache_key(request), request.raw_path, ttl)
+    except Exception as e:
+        logger.warning(f"Proxy fetch failed for {request.path_qs}: {e}")
+        redirect_upstream(request)
+    cache_requests.inc(route=route_label(request), result=result)
+    return payload.response(request)
+
+
+def redirect_upstream(request):
+    cache_requests.inc(route=route_label(request), result="redirect")
+    raise web.HTTPFound(f"{config.tdx_api_root}{request.path_qs}")
+
+
+async def catch_all(request):
+    return await proxy_upstream(request)
+
+
+def create_app():
+    app = web.Application()
+    app.router.add_get(STATION_MAP_PATH, station_map)
+    app.router.add_get(STATION_TABLE_TODAY_PATH, station_table)
+    app.router.add_get(f"{STATION_TABLE_PATH_DATE}/{{date}}", station_table_date)
+    app.router.add_get(TRAIN_TABLE_TODAY_PATH, train_table)
+    app.router.add_get(f"{TRAIN_TABLE_PATH_DATE}/{{date}}", train_table_date)
+    app.router.add_get(TRAIN_LIVE_PATH, train_live)
+    app.router.add_get("/metrics", metrics.handle_metrics)
+    app.router.add_get("/{path:.*}", catch_all)
+    return app
+
+
+async def main():
+    global cache_manager, proxy_cache
+    requester = TDXRequester(api_root=config.tdx_api_root)
+    cache_manager = CacheManager(requester)
+    proxy_cache = ProxyCache(requester)
+    await cache_manager.fetch_init()
+
+    # Serve on the same event loop as the cache, no per-request serialization
+    runner = web.AppRunner(create_app())
+    await runner.setup()
+    site = web.TCPSite(runner, port=config.tdx_relay_server_port)
+    await site.start()
+    logger.info(f"Relay listening on port {config.tdx_relay_server_port}")
 
-    # Keep the scheduler running
-    while True:
-        schedule.run_pending()
-        await asyncio.sleep(1)
+    # Refresh on this loop so the jobs share the requester's connection pool
+    try:
+        await asyncio.gather(
+            run_daily("00:00", cache_manager.fetch_daily),
+            run_every(20, cache_manager.fetch_live),
+        )
+    finally:
+        await runner.cleanup()
+        await requester.close()
 
 
 if __name__ == "__main__":
@@ -1,55 +1,326 @@
 import aiohttp
 import asyncio
+import codecs
 import config
+import hashlib
+import json
 import logging
 import random
+import re
 import time
 
+import metrics
+
 # Configure logging
 logging.basicConfig(level=config.log_level)
 logger = logging.getLogger(__name__)
 
 token_expire_time = 3600 * 23
 
-async def basic_query(url, method="GET", data=None, headers=None):
+# Connection pool settings, may be overridden in config
+connection_limit = (
+    config.tdx_connection_limit if hasattr(config, "tdx_connection_limit") else 16
+)
+keepalive_timeout = (
+    config.tdx_keepalive_timeout if hasattr(config, "tdx_keepalive_timeout") else 60
+)
+dns_cache_ttl = config.tdx_dns_cache_ttl if hasattr(config, "tdx_dns_cache_ttl") else 600
+
+# Rate limit matched to the TDX plan quota (requests per second), may be overridden in config
+rate_limit = config.tdx_rate_limit if hasattr(config, "tdx_rate_limit") else 5
+rate_burst = config.tdx_rate_burst if hasattr(config, "tdx_rate_burst") else 5
+
+# Retry with capped exponential backoff and jitter on 429/5xx
+max_retries = config.tdx_max_retries if hasattr(config, "tdx_max_retries") else 8
+backoff_base = 1
+backoff_cap = 60
+
+# Relay request timeout and hedging budget (None: twice the relay's average latency)
+relay_timeout = config.tdx_relay_timeout if hasattr(config, "tdx_relay_timeout") else 10
+relay_hedge_after = (
+    config.tdx_relay_hedge_after if hasattr(config, "tdx_relay_hedge_after") else None
+)
+
+# returned by TDXRequester.get/get_raw(conditional=True) when the data has not changed
+UNCHANGED = object()
+
+http_requests = metrics.counter(
+    "tdx_http_requests_total", "HTTP requests sent, by host and status", ("host", "status")
+)
+http_retries = metrics.counter(
+    "tdx_http_retries_total", "Requests retried after 429/5xx", ("host",)
+)
+fetch_seconds = metrics.histogram(
+    "tdx_fetch_seconds", "Time to fetch an endpoint, including retries", ("endpoint",)
+)
+response_bytes = metrics.histogram(
+    "tdx_response_bytes",
+    "Response body size",
+    ("endpoint",),
+    buckets=metrics.BYTE_BUCKETS,
+)
+unchanged_responses = metrics.counter(
+    "tdx_unchanged_responses_total",
+    "Conditional fetches answered by 304 or an identical body",
+    ("endpoint",),
+)
+coalesced_requests = metrics.counter(
+    "tdx_coalesced_requests_total", "GETs that joined an in-flight request", ("endpoint",)
+)
+token_refreshes = metrics.counter("tdx_token_refreshes_total", "Access tokens fetched")
+relay_failures = metrics.counter(
+    "tdx_relay_failures_total", "Failed relay requests", ("relay",)
+)
+relay_circuit_opens = metrics.counter(
+    "tdx_relay_circuit_opens_total", "Times a relay circuit was opened", ("relay",)
+)
+
+
+def endpoint_label(subpath):
+    # 去掉查詢參數與日期，避免標籤數量無限增加
+    path = subpath.split("?", 1)[0]
+    return re.sub(r"/\d{4}-\d{2}-\d{2}$", "/{date}", path)
+
+
+class TokenBucket:
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    async def acquire(self):
+        # 先預約一個額度，不足時等待到額度補回為止
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= 1
+        if self.tokens < 0:
+            await asyncio.sleep(-self.tokens / self.rate)
+
+
+def should_retry(status):
+    return status == 429 or 500 <= status < 600
+
+
+def retry_delay(attempt, retry_after=None):
+    # full jitter, honoring Retry-After if the server sent one
+    if retry_after is not None:
+        try:
+            return min(backoff_cap, float(retry_after))
+        except ValueError:
+            pass
+    return random.uniform(0, min(backoff_cap, backoff_base * 2**attempt))
+
+
+def create_session():
+    # 共用連線池，保持連線並快取 DNS，避免每次請求都重新做 TCP+TLS 握手
+    connector = aiohttp.TCPConnector(
+        limit=connection_limit,
+        keepalive_timeout=keepalive_timeout,
+        ttl_dns_cache=dns_cache_ttl,
+    )
+    return aiohttp.ClientSession(connector=connector)
+
+
+async def basic_request(
+    url,
+    method="GET",
+    data=None,
+    headers=None,
+    session=None,
+    limiter=None,
+    retries=max_retries,
+):
+    # returns (status, raw body, response headers)
+    # without a shared session, fall back to a one-off session
+    if session is None:
+        async with create_session() as session:
+            return await basic_request(
+                url, method, data, headers, session, limiter, retries
+            )
+    attempt = 0
     while True:
-        async with aiohttp.ClientSession() as session:
+        if limiter is not None:
+            await limiter.acquire()
+        try:
+            async with session.request(
+                method=method,
+                url=url,
+                data=data if method == "POST" else None,
+                headers=headers,
+            ) as response:
+                http_requests.inc(host=response.url.host, status=response.status)
+                # handle 429 (Too Many Requests) and 5xx
+                if should_retry(response.status) and attempt < retries:
+                    http_retries.inc(host=response.url.host)
+                    delay = retry_delay(attempt, response.headers.get("Retry-After"))
+                    logger.warning(
+                        f"Request failed, status={response.status}, retrying in {delay:.1f} seconds"
+                    )
+                    attempt += 1
+                    await asyncio.sleep(delay)
+                    continue
+                return (response.status, await response.read(), response.headers)
+        except aiohttp.ClientError as e:
+            logger.error(f"Client error: {e}")
+            raise
+        except Exception as e:
+            logger.error(f"Unexpected error: {e}")
+            raise
+
+
+def decode_response(status, body):
+    # handle 200 (OK)
+    if status == 200:
+        try:
+            return json.loads(body)
+        except Exception as e:
+            logger.error(f"Failed to parse JSON response: {e}")
+            raise
+    # handle other errors
+    error_text = body.decode("utf-8", errors="replace")
+    logger.error(f"Request failed, status={status}, response={error_text}")
+    return error_text
+
+
+async def basic_query(url, method="GET", data=None, headers=None, session=None):
+    status, body, _ = await basic_request(url, method, data, headers, session)
+    return (status, decode_response(status, body))
+
+
+async def iter_json_items(chunks, key):
+    # 從位元組串流中逐一解出頂層 key 陣列內的物件，不必把整份回應放進記憶體
+    decoder = json.JSONDecoder()
+    text_decoder = codecs.getincrementaldecoder("utf-8")()
+    buffer = ""
+    pos = 0
+    in_array = False
+    finished = False
+    async for chunk in chunks:
+        buffer = buffer[pos:] + text_decoder.decode(chunk)
+        pos = 0
+        if not in_array:
+            start = buffer.find(f'"{key}"')
+            if start < 0:
+                # keep the tail in case the key is split across chunks
+                pos = max(0, len(buffer) - len(key) - 2)
+                continue
+            bracket = buffer.find("[", start)
+            if bracket < 0:
+                pos = start
+                continue
+            pos = bracket + 1
+            in_array = True
+        while True:
+            while pos < len(buffer) and buffer[pos] in " \t\r\n,":
+                pos += 1
+            if pos >= len(buffer):
+                break
+            if buffer[pos] == "]":
+                finished = True
+                break
             try:
-                async with session.request(
-                    method=method,
-                    url=url,
-                    data=data if method == "POST" else None,
-                    headers=headers,
-                ) as response:
-                    # handle 200 (OK)
-                    if response.status == 200:
-                        try:
-                            return (response.status, await response.json())
-                        except Exception as e:
-                            logger.error(f"Failed to parse JSON response: {e}")
-                            raise
-
-                    # handle 429 (Too Many Requests)
-                    elif response.status == 429:
-                        logger.warning("Too many requests, retrying in 5 seconds")
-                        await asyncio.sleep(5)
-
-                    # handle other errors
-                    else:
-                        error_text = await response.text()
-                        logger.error(
-                            f"Request failed, status={response.status}, response={error_text}"
-                        )
-                        return (response.status, error_text)
-            except aiohttp.ClientError as e:
-                logger.error(f"Client error: {e}")
-                raise
-            except Exception as e:
-                logger.error(f"Unexpected error: {e}")
-                raise
+                item, pos = decoder.raw_decode(buffer, pos)
+            except json.JSONDecodeError:
+                break  # item not complete yet, wait for more data
+            yield item
+        if finished:
+            return
+    if not finished:
+        raise ValueError(f"Incomplete JSON array: {key}")
+
+
+class RelayError(Exception):
+    pass
+
+
+class RelayState:
+    __slots__ = ("url", "latency", "error_rate", "failures", "trips", "open_until", "probing")
 
+    def __init__(self, url):
+        self.url = url
+        self.latency = None  # EWMA，秒
+        self.error_rate = 0.0  # EWMA
+        self.failures = 0  # 連續失敗次數
+        self.trips = 0  # 連續斷路次數，用於拉長冷卻時間
+        self.open_until = 0  # 斷路到期時間，0 代表正常
+        self.probing = False  # 斷路到期後只放行一個探測請求
 
-async def tdx_fetch_token(api_id, api_secret, url):
+
+class RelaySelector:
+    # 依各中繼站的延遲與錯誤率挑選，連續失敗就斷路，冷卻後以單一請求探測
+    alpha = 0.3
+    failure_threshold = 3
+    cooldown = 30
+    max_cooldown = 600
+
+    def __init__(self, relays):
+        self.states = {url: RelayState(url) for url in relays}
+
+    def score(self, state):
+        # 尚未量測過的中繼站優先嘗試
+        return (state.latency or 0) * (1 + 4 * state.error_rate)
+
+    def choose(self, exclude=()):
+        now = time.monotonic()
+        candidates = [
+            state
+            for state in self.states.values()
+            if state.url not in exclude
+            and (state.open_until == 0 or (now >= state.open_until and not state.probing))
+        ]
+        if not candidates:
+            return None
+        best = min(candidates, key=self.score)
+        if best.open_until:
+            logger.info(f"Probing relay {best.url}")
+            best.probing = True
+        return best.url
+
+    def hedge_delay(self, url):
+        if relay_hedge_after is not None:
+            return relay_hedge_after
+        latency = self.states[url].latency
+        return relay_timeout if latency is None else max(0.2, 2 * latency)
+
+    def record_latency(self, url, latency):
+        state = self.states[url]
+        state.latency = (
+            latency
+            if state.latency is None
+            else self.alpha * latency + (1 - self.alpha) * state.latency
+        )
+
+    def record_success(self, url, latency):
+        state = self.states[url]
+        self.record_latency(url, latency)
+        state.error_rate *= 1 - self.alpha
+        if state.open_until:
+            logger.info(f"Relay {url} recovered")
+        state.failures = state.trips = state.open_until = 0
+        state.probing = False
+
+    def release(self, url):
+        # 請求結束但沒有結果 (例如輸給對沖請求而被取消)，探測不算成功也不算失敗，下次再探測
+        self.states[url].probing = False
+
+    def record_failure(self, url):
+        relay_failures.inc(relay=url)
+        state = self.states[url]
+        state.error_rate = self.alpha + (1 - self.alpha) * state.error_rate
+        state.failures += 1
+        if state.probing or state.failures >= self.failure_threshold:
+            cooldown = min(self.max_cooldown, self.cooldown * 2**state.trips)
+            logger.warning(f"Relay {url} unhealthy, circuit open for {cooldown} seconds")
+            state.open_until = time.monotonic() + cooldown
+            state.trips += 1
+            relay_circuit_opens.inc(relay=url)
+        state.probing = False
+
+
+async def tdx_fetch_token(api_id, api_secret, url, session=None):
+    # returns (access_token, expires_in)
     data = {
         "grant_type": "client_credentials",
         "client_id": api_id,
@@ -57,7 +328,7 @@ async def tdx_fetch_token(api_id, api_secret, url):
     }
     try:
         response_status, response_data = await basic_query(
-            url, method="POST", data=data
+            url, method="POST", data=data, session=session
         )
         if response_status != 200:
             raise ValueError(
@@ -65,7 +336,7 @@ async def tdx_fetch_token(api_id, api_secret, url):
             )
         access_token = response_data["access_token"]
         if access_token:
-            return access_token
+            return access_token, response_data.get("expires_in", token_expire_time)
         else:
             raise ValueError("Access token not found in response.")
     except ValueError as ve:
@@ -77,33 +348,76 @@ async def tdx_fetch_token(api_id, api_secret, url):
 
 
 class TDXTokenManager:
-    def __init__(self, api_id, api_secret, auth_root):
+    # 有效期剩下這個比例時就在背景換發新的令牌
+    refresh_ratio = 0.1
+    # 背景換發失敗後等待的秒數，期間繼續使用仍有效的令牌
+    refresh_backoff = 60
+
+    def __init__(self, api_id, api_secret, auth_root, get_session=None):
         self.api_id = api_id
         self.api_secret = api_secret
         self.auth_root = auth_root
+        self.get_session = get_session
         self.token = None
-        self.last_fetch_time = time.time() - token_expire_time
-        self.lock = asyncio.Lock()  # 增加锁以保护令牌更新操作
+        self.expire_time = 0
+        self.refresh_time = 0
+        self.refresh_task = None  # 進行中的換發，所有呼叫端共用同一個
+        self.failed_time = 0  # 上次換發失敗的時間
 
     async def get(self):
         now = time.time()
-        async with self.lock:  # 确保令牌更新操作是线程安全的
-            if now - self.last_fetch_time > token_expire_time or not self.token:
-                logger.info("Fetching new token...")
-                self.last_fetch_time = now
-                self.token = await tdx_fetch_token(
-                    self.api_id, self.api_secret, self.auth_root
-                )
-                logger.info("Token fetched successfully.")
-            else:
-                logger.debug("Using cached token.")
-        return self.token
+        # 令牌有效時直接回傳，不需要上鎖
+        if self.token and now < self.refresh_time:
+            return self.token
+        if self.token and now < self.expire_time:
+            # 即將到期，背景換發並先使用目前的令牌；剛失敗過就先不重試，避免每個請求都換發一次
+            if now >= self.failed_time + self.refresh_backoff:
+                self.start_refresh()
+            return self.token
+        return await self.wait_refresh()
+
+    def start_refresh(self):
+        if self.refresh_task is None or self.refresh_task.done():
+            self.refresh_task = asyncio.create_task(self.fetch())
+            self.refresh_task.add_done_callback(log_refresh_error)
+        return self.refresh_task
+
+    async def wait_refresh(self):
+        return await asyncio.shield(self.start_refresh())
+
+    async def fetch(self):
+        logger.info("Fetching new token...")
+        now = time.time()
+        try:
+            token, expires_in = await tdx_fetch_token(
+                self.api_id,
+                self.api_secret,
+                self.auth_root,
+                self.get_session() if self.get_session else None,
+            )
+        except Exception:
+            self.failed_time = time.time()
+            raise
+        self.failed_time = 0
+        token_refreshes.inc()
+        self.token = token
+        self.expire_time = now + expires_in
+        self.refresh_time = now + expires_in * (1 - self.refresh_ratio)
+        logger.info(f"Token fetched successfully, expires in {expires_in} seconds.")
+        return token
 
-    async def refresh(self):
-        async with self.lock:
-            logger.info("Refreshing token...")
-            self.last_fetch_time = time.time() - token_expire_time
-            await self.get()
+    async def refresh(self, rejected_token=None):
+        # 多個請求同時收到 401 時只換發一次；令牌已被換過就直接使用新的
+        if rejected_token is not None and rejected_token != self.token:
+            return self.token
+        logger.info("Refreshing token...")
+        self.refresh_time = self.expire_time = 0
+        return await self.wait_refresh()
+
+
+def log_refresh_error(task):
+    if not task.cancelled() and task.exception() is not None:
+        logger.error(f"Failed to refresh token: {task.exception()}")
 
 
 class TDXRequester:
@@ -117,37 +431,272 @@ class TDXRequester:
             config.tdx_api_relay if hasattr(config, "tdx_api_relay") else None
         ),  # api_relay is an array, may contain multiple urls
     ):
-        self.token_manager = TDXTokenManager(api_id, api_secret, auth_root)
+        self._session = None
+        self.token_manager = TDXTokenManager(
+            api_id, api_secret, auth_root, self.get_session
+        )
         self.api_root = api_root
         self.api_relay = api_relay
+        self.relays = RelaySelector(api_relay) if api_relay else None
+        self.validators = {}  # subpath -> last ETag/Last-Modified/body digest
+        # 新的驗證資訊要等呼叫端套用資料後才生效，解析或套用失敗時下次仍會取得完整內容
+        self.pending_validators = {}
+        self.limiter = TokenBucket(rate_limit, rate_burst) if rate_limit else None
+        self.inflight = {}  # 相同的 GET 同時發出時共用同一個上游請求
         if self.api_relay is not None:
             logger.info(f"Using relay: {self.api_relay}")
 
-    async def get(self, subpath, no_relay=False):
-        headers = {"Authorization": f"Bearer {await self.token_manager.get()}"}
-        # if api_relay is not None, try one of them ramdomly
-        if self.api_relay is not None and not no_relay:
-            api_root = self.api_relay[random.randint(0, len(self.api_relay) - 1)]
-        else:
-            api_root = self.api_root
+    def get_session(self):
+        # session must be created inside the running event loop, so create it lazily
+        if self._session is None or self._session.closed:
+            self._session = create_session()
+        return self._session
+
+    async def close(self):
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
+
+    def choose_api_root(self, no_relay=False):
+        # prefer the fastest healthy relay, fall back to api_root when none is available
+        if self.relays is not None and not no_relay:
+            relay = self.relays.choose()
+            if relay is not None:
+                return relay
+        return self.api_root
+
+    async def request_relay(self, relay, subpath, headers):
+        start = time.monotonic()
         try:
-            response_status, ret = await basic_query(
-                api_root + subpath, headers=headers
-            )
-            if response_status == 200:
-                return ret
-            elif response_status == 401:
-                logger.warning("Token expired, refreshing...")
-                await self.token_manager.refresh()
-                return await self.get(subpath)
-            else:
-                raise ValueError(f"Failed to fetch data: {response_status}, {ret}")
-        # if failed to fetch data from api_relay, try to fetch data directly from api_root
-        except aiohttp.ClientError as e:
-            if self.api_relay is not None and not no_relay:
+            try:
+                response = await asyncio.wait_for(
+                    basic_request(
+                        relay + subpath,
+                        headers=headers,
+                        session=self.get_session(),
+                        retries=0,
+                    ),
+                    relay_timeout,
+                )
+            except asyncio.CancelledError:
+                # 被對沖請求取代時，已經過的時間仍計入延遲
+                self.relays.record_latency(relay, time.monotonic() - start)
+                raise
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                self.relays.record_failure(relay)
+                raise
+            if should_retry(response[0]):
+                self.relays.record_failure(relay)
+                raise RelayError(f"Relay {relay} returned {response[0]}")
+            self.relays.record_success(relay, time.monotonic() - start)
+            return response
+        finally:
+            # 被取消或其他例外時也要結束探測，否則斷路中的中繼站不會再被選到
+            self.relays.release(relay)
+
+    async def request_relays(self, subpath, headers):
+        primary = self.relays.choose()
+        if primary is None:
+            raise RelayError("No healthy relay")
+        tasks = {asyncio.create_task(self.request_relay(primary, subpath, headers))}
+        done, _ = await asyncio.wait(tasks, timeout=self.relays.hedge_delay(primary))
+        if not done:
+            # 超過延遲預算，對第二個中繼站發出對沖請求，先回來的為準
+            secondary = self.relays.choose(exclude=(primary,))
+            if secondary is not None:
+                logger.debug(f"Hedging {subpath} to {secondary}")
+                tasks.add(
+                    asyncio.create_task(self.request_relay(secondary, subpath, headers))
+                )
+        pending = tasks
+        error = None
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    for other in pending:
+                        other.cancel()
+                    return task.result()
+                error = task.exception()
+        raise error
+
+    def limiter_for(self, api_root):
+        # 只有直接打 TDX 才會消耗額度，中繼站不限速
+        return self.limiter if api_root == self.api_root else None
+
+    async def stream(self, subpath, no_relay=False, chunk_size=64 * 1024):
+        # 以串流方式讀取回應，供大型資料邊下載邊解析
+        api_root = self.choose_api_root(no_relay)
+        started = False
+        attempt = 0
+        while True:
+            token = await self.token_manager.get()
+            headers = {"Authorization": f"Bearer {token}"}
+            limiter = self.limiter_for(api_root)
+            if limiter is not None:
+                await limiter.acquire()
+            relay = api_root if api_root != self.api_root else None
+            start = time.monotonic()
+            try:
+                async with self.get_session().get(
+                    api_root + subpath, headers=headers
+                ) as response:
+                    http_requests.inc(host=response.url.host, status=response.status)
+                    if relay is not None:
+                        if should_retry(response.status):
+                            self.relays.record_failure(api_root)
+                            logger.warning(
+                                f"Relay returned {response.status}, streaming directly from api_root"
+                            )
+                            api_root = self.api_root
+                            continue
+                        self.relays.record_success(api_root, time.monotonic() - start)
+                    if should_retry(response.status) and attempt < max_retries:
+                        http_retries.inc(host=response.url.host)
+                        delay = retry_delay(attempt, response.headers.get("Retry-After"))
+                        logger.warning(
+                            f"Request failed, status={response.status}, retrying in {delay:.1f} seconds"
+                        )
+                        attempt += 1
+                        await asyncio.sleep(delay)
+                        continue
+                    elif response.status == 401:
+                        logger.warning("Token expired, refreshing...")
+                        await self.token_manager.refresh(token)
+                        continue
+                    elif response.status != 200:
+                        error_text = await response.text()
+                        raise ValueError(
+                            f"Failed to fetch data: {response.status}, {error_text}"
+                        )
+                    size = 0
+                    async for chunk in response.content.iter_chunked(chunk_size):
+                        started = True
+                        size += len(chunk)
+                        yield chunk
+                    response_bytes.observe(size, endpoint=endpoint_label(subpath))
+                    return
+            # if failed to connect to api_relay, try to fetch data directly from api_root
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+                if relay is None or started:
+                    raise
+                self.relays.record_failure(relay)
+                logger.warning(
+                    f"Failed to stream data from relay, try to fetch data directly from api_root: {e}"
+                )
+                api_root = self.api_root
+            finally:
+                if relay is not None:
+                    self.relays.release(relay)
+
+    def commit_validator(self, subpath):
+        # 呼叫端成功套用 conditional 請求的資料後呼叫
+        validator = self.pending_validators.pop(subpath, None)
+        if validator is not None:
+            self.validators[subpath] = validator
+
+    async def get(self, subpath, no_relay=False, conditional=False):
+        # returns the decoded JSON, or UNCHANGED
+        return await self.coalesce(
+            ("json", subpath, no_relay, conditional),
+            lambda: self.fetch(subpath, no_relay, conditional),
+        )
+
+    async def get_raw(self, subpath, no_relay=False, conditional=False):
+        # returns the upstream (status, body, headers) without decoding, or UNCHANGED
+        return await self.coalesce(
+            ("raw", subpath, no_relay, conditional),
+            lambda: self.fetch_timed(subpath, no_relay, conditional),
+        )
+
+    async def get_stream(self, subpath, consume, no_relay=False):
+        # consume(chunks) 邊下載邊解析並回傳結果；相同的請求共用同一次下載與解析結果
+        return await self.coalesce(
+            ("stream", subpath, no_relay, consume),
+            lambda: self.consume_timed(subpath, consume, no_relay),
+        )
+
+    async def consume_timed(self, subpath, consume, no_relay=False):
+        with fetch_seconds.time(endpoint=endpoint_label(subpath)):
+            return await consume(self.stream(subpath, no_relay))
+
+    async def coalesce(self, key, fetch):
+        if key not in self.inflight:
+            self.inflight[key] = asyncio.ensure_future(fetch())
+            self.inflight[key].add_done_callback(lambda _: self.inflight.pop(key, None))
+        else:
+            logger.debug(f"Joining in-flight request: {key[1]}")
+            coalesced_requests.inc(endpoint=endpoint_label(key[1]))
+        return await asyncio.shield(self.inflight[key])
+
+    async def fetch(self, subpath, no_relay=False, conditional=False):
+        response = await self.fetch_timed(subpath, no_relay, conditional)
+        if response is UNCHANGED:
+            return UNCHANGED
+        response_status, body, _ = response
+        return decode_response(response_status, body)
+
+    async def fetch_timed(self, subpath, no_relay=False, conditional=False):
+        with fetch_seconds.time(endpoint=endpoint_label(subpath)):
+            return await self.fetch_raw(subpath, no_relay, conditional)
+
+    async def fetch_raw(self, subpath, no_relay=False, conditional=False):
+        token = await self.token_manager.get()
+        headers = {"Authorization": f"Bearer {token}"}
+        # 帶上次的驗證資訊發出條件式請求，伺服器回 304 就不必重新下載
+        validator = self.validators.get(subpath) if conditional else None
+        if validator is not None:
+            if validator["etag"] is not None:
+                headers["If-None-Match"] = validator["etag"]
+            if validator["last_modified"] is not None:
+                headers["If-Modified-Since"] = validator["last_modified"]
+        if self.relays is not None and not no_relay:
+            try:
+                response = await self.request_relays(subpath, headers)
+            # if failed to fetch data from api_relay, try to fetch data directly from api_root
+            except (aiohttp.ClientError, asyncio.TimeoutError, RelayError) as e:
                 logger.warning(
                     f"Failed to fetch data from relay, try to fetch data directly from api_root: {e}"
                 )
-                return await self.get(subpath, no_relay=True)
-            else:
-                raise
+                return await self.fetch_raw(
+                    subpath, no_relay=True, conditional=conditional
+                )
+        else:
+            response = await basic_request(
+                self.api_root + subpath,
+                headers=headers,
+                session=self.get_session(),
+                limiter=self.limiter,
+            )
+        response_status, body, response_headers = response
+        if response_status == 304 and validator is not None:
+            logger.debug(f"Not modified: {subpath}")
+            unchanged_responses.inc(endpoint=endpoint_label(subpath))
+            return UNCHANGED
+        elif response_status == 200:
+            response_bytes.observe(len(body), endpoint=endpoint_label(subpath))
+            digest = hashlib.blake2b(body, digest_size=16).digest()
+            if validator is not None and validator["digest"] == digest:
+                logger.debug(f"Unchanged body: {subpath}")
+                unchanged_responses.inc(endpoint=endpoint_label(subpath))
+                return UNCHANGED
+            if conditional:
+                self.pending_validators[subpath] = {
+                    "etag": response_headers.get("ETag"),
+                    "last_modified": response_headers.get("Last-Modified"),
+                    "digest": digest,
+                }
+            return response
+        elif response_status == 401:
+            logger.warning("Token expired, refreshing...")
+            await self.token_manager.refresh(token)
+            return await self.fetch_raw(subpath, no_relay, conditional)
+        else:
+            ret = decode_response(response_status, body)
+            raise ValueError(f"Failed to fetch data: {response_status}, {ret}")
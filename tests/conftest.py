@@ -0,0 +1,17 @@
+import importlib.util
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+try:
+    import config
+except ImportError:
+    # 沒有 config.py 時以 config.example.py 的設定執行
+    spec = importlib.util.spec_from_file_location(
+        "config", os.path.join(ROOT, "config.example.py")
+    )
+    config = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(config)
+    sys.modules["config"] = config
@@ -0,0 +1,54 @@
+# 本機的假 TDX 伺服器，提供令牌，任何路徑都回傳 body，並記錄收到的請求
+import asyncio
+
+from aiohttp import web
+
+
+class FakeTDX:
+    def __init__(self):
+        self.body = b"{}"
+        self.etag = None
+        self.delay = 0  # 回應前等待的秒數，用來讓請求重疊
+        self.expire_tokens = 0  # 接下來幾次請求回 401
+        self.tokens = 0  # 收到的令牌請求數
+        self.auth_status = 200
+        self.requests = []  # (path, If-None-Match, Authorization)
+        self.runner = None
+        self.url = None
+
+    async def token(self, request):
+        self.tokens += 1
+        if self.auth_status != 200:
+            return web.json_response({"error": "unavailable"}, status=self.auth_status)
+        return web.json_response({"access_token": f"token-{self.tokens}", "expires_in": 3600})
+
+    async def live(self, request):
+        self.requests.append(
+            (
+                request.path_qs,
+                request.headers.get("If-None-Match"),
+                request.headers.get("Authorization"),
+            )
+        )
+        await asyncio.sleep(self.delay)
+        if self.expire_tokens > 0:
+            self.expire_tokens -= 1
+            return web.Response(status=401, text="token expired")
+        headers = {} if self.etag is None else {"ETag": self.etag}
+        if self.etag is not None and request.headers.get("If-None-Match") == self.etag:
+            return web.Response(status=304, headers=headers)
+        return web.Response(body=self.body, headers=headers, content_type="application/json")
+
+    async def __aenter__(self):
+        app = web.Application()
+        app.router.add_post("/token", self.token)
+        app.router.add_get("/{path:.*}", self.live)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        await web.TCPSite(self.runner, "127.0.0.1", 0).start()
+        host, port = self.runner.addresses[0][:2]
+        self.url = f"http://{host}:{port}"
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.runner.cleanup()
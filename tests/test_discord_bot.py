@@ -0,0 +1,62 @@
+import asyncio
+import os
+from types import SimpleNamespace
+
+import discord_bot
+from task_store import TaskStore
+
+SCHEMA_PATH = os.path.join(os.path.dirname(os.path.dirname(__file__)), "schema.json")
+
+
+class FakeResponse:
+    def __init__(self):
+        self.messages = []
+
+    async def send_message(self, content, ephemeral=False):
+        self.messages.append((content, ephemeral))
+
+
+def test_on_ready_initializes_once_and_commands_wait(tmp_path, monkeypatch):
+    calls = []
+    release = asyncio.Event()
+    provider = SimpleNamespace(station_live_table=SimpleNamespace(prewarm=lambda station_ids: None))
+    provider.start = lambda: provider
+
+    async def create_resource_provider():
+        calls.append("resource_provider")
+        await release.wait()
+        return provider
+
+    async def sync():
+        return []
+
+    monkeypatch.setattr(discord_bot, "create_resource_provider", create_resource_provider)
+    monkeypatch.setattr(
+        discord_bot, "TaskStore", lambda: TaskStore(str(tmp_path / "tasks.db"), SCHEMA_PATH)
+    )
+    monkeypatch.setattr(discord_bot, "METRICS_PORT", None)
+    monkeypatch.setattr(discord_bot.bot.tree, "sync", sync)
+    monkeypatch.setattr(type(discord_bot.bot), "user", SimpleNamespace(id=1))
+    monkeypatch.setattr(discord_bot.monitor_registry, "start", lambda: calls.append("monitors"))
+    # 測試結束後還原模組狀態
+    for name in ("resource_provider", "task_store", "initializing", "ready"):
+        monkeypatch.setattr(discord_bot, name, getattr(discord_bot, name))
+
+    async def main():
+        first = asyncio.create_task(discord_bot.on_ready())
+        await asyncio.sleep(0)
+        # 初始化期間重新連線，不應再初始化一次
+        await discord_bot.on_ready()
+        interaction = SimpleNamespace(response=FakeResponse())
+        await discord_bot.station.callback(interaction, "1000")
+        assert interaction.response.messages == [("機器人尚未準備好，請稍後再試", True)]
+        assert await discord_bot.station_autocomplete(interaction, "1") == []
+        release.set()
+        await first
+        try:
+            assert calls == ["resource_provider", "monitors"]
+            assert discord_bot.ready
+        finally:
+            await discord_bot.task_store.close()
+
+    asyncio.run(main())
@@ -0,0 +1,49 @@
+import asyncio
+import json
+
+import pytest
+
+from tdx_requester import iter_json_items
+
+PAYLOAD = {
+    "UpdateTime": "2026-03-02T08:00:00+08:00",
+    "TrainDate": "2026-03-02",
+    "TrainTimetables": [
+        {"TrainInfo": {"TrainNo": "101", "Note": 'say "hi" {not an object}'}, "StopTimes": []},
+        {"TrainInfo": {"TrainNo": "103", "Note": 'a ] and [ and \\ and "}"'}, "StopTimes": [1, 2]},
+        {"TrainInfo": {"TrainNo": "105", "Note": "臺北→高雄，跨日 🚆"}, "StopTimes": [{"A": None}]},
+    ],
+    "Trailing": {"TrainTimetables": "ignored"},
+}
+
+
+async def chunked(body, size):
+    for start in range(0, len(body), size):
+        yield body[start : start + size]
+
+
+def collect(body, size, key="TrainTimetables"):
+    async def main():
+        return [item async for item in iter_json_items(chunked(body, size), key)]
+
+    return asyncio.run(main())
+
+
+@pytest.mark.parametrize("size", [1, 7, 64, 1 << 20])
+def test_items_survive_any_chunk_split(size):
+    for body in (
+        json.dumps(PAYLOAD, ensure_ascii=False).encode(),
+        json.dumps(PAYLOAD, indent=2).encode(),
+    ):
+        assert collect(body, size) == PAYLOAD["TrainTimetables"]
+
+
+@pytest.mark.parametrize("size", [1, 7])
+def test_empty_array(size):
+    assert collect(b'{"TrainTimetables" : [ ] }', size) == []
+
+
+def test_incomplete_array_raises():
+    body = json.dumps(PAYLOAD).encode()
+    with pytest.raises(ValueError):
+        collect(body[: len(body) // 2], 7)
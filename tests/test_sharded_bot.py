@@ -0,0 +1,32 @@
+import asyncio
+import time
+
+import benchmark
+from sharded_bot import SharedResourceProvider, publish_segment
+from train_live import TrainPositionTable
+
+
+def test_worker_generation_keeps_publisher_slot():
+    fixtures, live_data = benchmark.synthesize_fixtures(7, 50)
+    resources = benchmark.build_tables(fixtures)
+    train_live = TrainPositionTable().parse(live_data["midnight"])
+    train_live.last_fetched_time = time.time()
+    segment, size = publish_segment(train_live.to_snapshot())
+
+    async def test():
+        provider = SharedResourceProvider(connection=None)
+        provider.station_table = resources.station_table
+        provider.station_table_tomorrow = resources.station_table_tomorrow
+        # 監視器延遲要從發布端的更新時間點算起，而不是分片程序收到通知的時間
+        await provider.apply_message("live", segment.name, size, 1000.0)
+        assert provider.generation == 1
+        assert provider.generation_slot == 1000.0
+        await provider.apply_message("tick", None, 0, 1020.0)
+        assert provider.generation == 2
+        assert provider.generation_slot == 1020.0
+
+    try:
+        asyncio.run(test())
+    finally:
+        segment.close()
+        segment.unlink()
@@ -0,0 +1,32 @@
+import asyncio
+
+import benchmark
+import snapshot
+from resource_provider import ResourceProvider
+
+
+def test_snapshot_round_trip(tmp_path, monkeypatch):
+    monkeypatch.setattr(snapshot, "snapshot_dir", str(tmp_path))
+    fixtures, _ = benchmark.synthesize_fixtures(3, 50)
+    resources = benchmark.build_tables(fixtures)
+    provider = ResourceProvider(requester=None)
+    for name in (
+        "station_table",
+        "station_table_tomorrow",
+        "train_table",
+        "train_table_tomorrow",
+        "station_id_translator",
+        "train_type_translator",
+    ):
+        setattr(provider, name, getattr(resources, name))
+    snapshot.save_snapshot("2026-03-02", provider.to_snapshot())
+
+    async def main():
+        loaded = ResourceProvider(requester=None)
+        assert not await loaded.load_snapshot("2026-03-01")
+        assert await loaded.load_snapshot("2026-03-02")
+        return loaded
+
+    loaded = asyncio.run(main())
+    assert loaded.train_date == "2026-03-02"
+    assert loaded.to_snapshot() == provider.to_snapshot()
@@ -0,0 +1,160 @@
+import random
+from datetime import date, datetime
+
+import benchmark
+from station_live import StationLiveTable, current_minutes, service_date, service_dates
+from station_table import StationTable
+from train_live import TrainPositionTable
+from train_table import TrainTable
+
+TODAY = "2026-03-02"
+TOMORROW = "2026-03-03"
+
+
+def stop(sequence, station_id, time):
+    return {
+        "StopSequence": sequence,
+        "StationID": station_id,
+        "ArrivalTime": time,
+        "DepartureTime": time,
+    }
+
+
+def timetables(date):
+    # 101 為跨日班次，23:50 由 1000 發車，00:05 離開 1500
+    trains = {
+        "101": [stop(1, "1000", "23:50"), stop(2, "1500", "00:05"), stop(3, "1800", "00:30")],
+        "103": [stop(1, "1000", "06:00"), stop(2, "1500", "06:20"), stop(3, "1800", "06:45")],
+    }
+    train_table = {
+        "TrainDate": date,
+        "TrainTimetables": [
+            {
+                "TrainInfo": {
+                    "TrainNo": train_no,
+                    "Direction": 0,
+                    "TrainTypeID": "1131",
+                    "TrainTypeCode": "6",
+                    "StartingStationID": stops[0]["StationID"],
+                    "EndingStationID": stops[-1]["StationID"],
+                    "TripLine": 0,
+                    "SuspendedFlag": 0,
+                    **({"OverNightStationID": "1500"} if train_no == "101" else {}),
+                },
+                "StopTimes": stops,
+            }
+            for train_no, stops in trains.items()
+        ],
+    }
+    station_table = {
+        "TrainDate": date,
+        "StationTimetables": [
+            {
+                "StationID": station_id,
+                "Direction": 0,
+                "TimeTables": [
+                    {
+                        "TrainNo": train_no,
+                        "ArrivalTime": s["ArrivalTime"],
+                        "DepartureTime": s["DepartureTime"],
+                        "DestinationStationID": stops[-1]["StationID"],
+                        "TrainTypeID": "1131",
+                        "TrainTypeCode": "6",
+                    }
+                    for train_no, stops in trains.items()
+                    for s in stops[:-1]
+                    if s["StationID"] == station_id
+                ],
+            }
+            for station_id in ("1000", "1500")
+        ],
+    }
+    train_table = TrainTable(date).parse(train_table)
+    station_table = StationTable(date).parse(station_table).apply_overnight(train_table)
+    return station_table
+
+
+def live(delays):
+    return TrainPositionTable().parse(
+        {
+            "UpdateTime": "2026-03-02T23:58:00+08:00",
+            "SrcUpdateTime": "2026-03-02T23:58:00+08:00",
+            "TrainLiveBoards": [
+                {
+                    "TrainNo": train_no,
+                    "TrainTypeID": "1131",
+                    "StationID": "1000",
+                    "DelayTime": delay,
+                    "UpdateTime": "2026-03-02T23:58:00+08:00",
+                }
+                for train_no, delay in delays.items()
+            ]
+        }
+    )
+
+
+def board(table, station_id="1500"):
+    return [(train.train_no, train.delayed_departure) for train in table[station_id].sorted()]
+
+
+def test_service_day_starts_at_cutover():
+    assert service_date(datetime(2026, 3, 3, 0, 10)) == date(2026, 3, 2)
+    assert service_date(datetime(2026, 3, 3, 3, 0)) == date(2026, 3, 3)
+    assert current_minutes(datetime(2026, 3, 3, 0, 10)) == 24 * 60 + 10
+    assert current_minutes(datetime(2026, 3, 3, 3, 0)) == 3 * 60
+    assert service_dates(datetime(2026, 3, 3, 0, 10)) == (TODAY, TOMORROW)
+    assert service_dates(datetime(2026, 3, 3, 12, 0)) == (None, "2026-03-04")
+
+
+def test_overnight_train_stays_across_midnight():
+    today, tomorrow = timetables(TODAY), timetables(TOMORROW)
+    table = StationLiveTable(today, tomorrow, live({"101": 2}), datetime(2026, 3, 2, 23, 58))
+    assert board(table)[0] == ("101", "00:07")
+
+    # 午夜時以同一營運日的時刻表重建，前一天的跨日班次仍在看板上
+    table = StationLiveTable(today, tomorrow, live({"101": 2}), datetime(2026, 3, 3, 0, 0))
+    assert board(table)[0] == ("101", "00:07")
+    table.tick(datetime(2026, 3, 3, 0, 6))
+    assert board(table)[0] == ("101", "00:07")
+    table.tick(datetime(2026, 3, 3, 0, 8))
+    assert board(table)[0] == ("103", "06:20")
+
+
+def test_overnight_train_leaves_after_cutover():
+    tomorrow, after = timetables(TOMORROW), timetables("2026-03-04")
+    table = StationLiveTable(tomorrow, after, live({}), datetime(2026, 3, 3, 3, 0))
+    assert board(table) == [("103", "06:20"), ("101", "00:05")]
+
+
+def snapshot(table):
+    # 同一分鐘發車的班次順序不固定，完整建立時也一樣，因此比較時再依車次排序
+    return {
+        station_id: sorted(
+            (train.departure_key, train.train_no, train.delay, train.departed)
+            for train in station_live.sorted()
+        )
+        for station_id, station_live in table.table.items()
+    }
+
+
+def test_update_matches_full_build_across_midnight_and_cutover():
+    fixtures, live_data = benchmark.synthesize_fixtures(7, 200)
+    resources = benchmark.build_tables(fixtures)
+    rng = random.Random(7)
+    tables = (resources.station_table, resources.station_table_tomorrow)
+    data = live_data["midnight"]
+    table = StationLiveTable(*tables, TrainPositionTable().parse(data), datetime(2026, 3, 2, 23, 58))
+    table.prewarm(table.station_ids())
+    for now in (
+        datetime(2026, 3, 2, 23, 59),
+        datetime(2026, 3, 3, 0, 0),
+        datetime(2026, 3, 3, 2, 59),
+        datetime(2026, 3, 3, 3, 0),
+    ):
+        data = benchmark.perturb_live(rng, data)
+        # 也有列車離開看板
+        data = dict(data, TrainLiveBoards=data["TrainLiveBoards"][1:])
+        train_live = TrainPositionTable().parse(data)
+        table.update(train_live, now)
+        expected = StationLiveTable(*tables, train_live, now).prewarm(table.station_ids())
+        assert snapshot(table) == snapshot(expected)
@@ -0,0 +1,44 @@
+import benchmark
+from station_table import StationTable
+from train_table import TrainTable
+
+
+def rows(station_table):
+    return {
+        station_id: sorted(
+            (
+                direction,
+                train.train_no,
+                train.arrival,
+                train.departure,
+                train.dest,
+                train.train_type,
+                train.train_level,
+                train.arrival_minutes,
+                train.departure_minutes,
+            )
+            for direction, trains in station_table[station_id].directions.items()
+            for train in trains.values()
+        )
+        for station_id in station_table.keys()
+    }
+
+
+def test_derived_station_table_matches_daily_station_timetable():
+    fixtures, _ = benchmark.synthesize_fixtures(11, 300)
+    for name in ("", "_tomorrow"):
+        train_table = TrainTable(fixtures[f"train_table{name}"]["TrainDate"]).parse(
+            fixtures[f"train_table{name}"]
+        )
+        parsed = StationTable().parse(fixtures[f"station_table{name}"])
+        parsed.apply_overnight(train_table)
+        derived = StationTable(train_table.date).from_train_table(train_table)
+        assert rows(derived) == rows(parsed)
+        # 跨日班次的時間要與列車時刻表一樣超過 24 小時
+        overnight = [
+            train
+            for station_id in derived.keys()
+            for train in derived[station_id].values()
+            if train.departure_minutes >= 24 * 60
+        ]
+        assert overnight
@@ -0,0 +1,122 @@
+import asyncio
+import json
+import os
+import sqlite3
+
+import pytest
+
+import task_store
+from task_store import TaskStore, TaskValidationError
+
+SCHEMA_PATH = os.path.join(os.path.dirname(os.path.dirname(__file__)), "schema.json")
+
+
+def test_guild_id_added_to_existing_database(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    path = str(tmp_path / "tasks.db")
+    connection = sqlite3.connect(path)
+    connection.execute(
+        "CREATE TABLE station_tasks (message_id INTEGER PRIMARY KEY, channel_id INTEGER NOT NULL,"
+        " station_id TEXT NOT NULL, destination_id TEXT, direction INTEGER, count INTEGER NOT NULL)"
+    )
+    connection.execute("INSERT INTO station_tasks VALUES (1, 10, '1000', NULL, NULL, 3)")
+    connection.commit()
+    connection.close()
+
+    async def main():
+        store = await TaskStore(path, SCHEMA_PATH).open()
+        try:
+            assert (await store.get(1))["guild_id"] is None
+            await store.insert(
+                {"message_id": "2", "channel_id": "20", "guild_id": "30", "station_id": "1000", "count": 3}
+            )
+            assert (await store.get(2))["guild_id"] == 30
+        finally:
+            await store.close()
+
+    asyncio.run(main())
+
+
+def test_legacy_tasks_migrated(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(task_store, "jsonschema", None)
+    station = {
+        "1": {"message_id": "1", "channel_id": "10", "station_id": "1000", "count": 3},
+        "2": {
+            "message_id": 2,
+            "channel_id": 20,
+            "guild_id": "30",
+            "station_id": "1000",
+            "destination_id": "1500",
+            "direction": 0,
+            "count": 5,
+        },
+        "3": {"message_id": "3", "channel_id": "10", "station_id": "1500", "count": 3},
+        # 以下皆不合法，應略過而不中斷匯入
+        "4": {"message_id": "4", "channel_id": "10", "station_id": "1000"},
+        "5": {"message_id": "5", "channel_id": "10", "station_id": "1000", "count": "3"},
+        "6": {"message_id": "6", "channel_id": "10", "station_id": "1000", "count": 3, "color": 1},
+        "7": {"message_id": "abc", "channel_id": "10", "station_id": "1000", "count": 3},
+    }
+    with open(tmp_path / "stored_tasks.json", "w", encoding="utf-8") as file:
+        json.dump({"tasks": {"station": station}}, file)
+
+    async def main():
+        store = await TaskStore(str(tmp_path / "tasks.db"), SCHEMA_PATH).open()
+        try:
+            tasks = sorted(await store.all(), key=lambda task: task["message_id"])
+            assert [task["message_id"] for task in tasks] == [1, 2, 3]
+            assert tasks[0] == {
+                "message_id": 1,
+                "channel_id": 10,
+                "guild_id": None,
+                "station_id": "1000",
+                "destination_id": None,
+                "direction": None,
+                "count": 3,
+            }
+            assert tasks[1]["guild_id"] == 30
+            assert tasks[1]["destination_id"] == "1500"
+            assert {task["message_id"] for task in await store.by_station("1000")} == {1, 2}
+            assert await store.station_ids() == {"1000", "1500"}
+            await store.delete(3)
+        finally:
+            await store.close()
+        # 改名後不再重複匯入，已刪除的任務不會回來
+        store = await TaskStore(str(tmp_path / "tasks.db"), SCHEMA_PATH).open()
+        try:
+            assert await store.get(3) is None
+        finally:
+            await store.close()
+
+    asyncio.run(main())
+    assert not (tmp_path / "stored_tasks.json").exists()
+    assert (tmp_path / "stored_tasks.json.migrated").exists()
+
+
+@pytest.mark.parametrize(
+    "task",
+    [
+        {"message_id": "1", "channel_id": "10", "station_id": "1000"},
+        {"message_id": "1", "channel_id": "10", "station_id": "1000", "count": "3"},
+        {"message_id": "1", "channel_id": "10", "station_id": 1000, "count": 3},
+        {"message_id": True, "channel_id": "10", "station_id": "1000", "count": 3},
+        {"message_id": "1", "channel_id": "10", "station_id": "1000", "count": 3, "color": 1},
+        ["1", "10", "1000", 3],
+    ],
+)
+def test_fallback_validator_rejects_invalid_tasks(tmp_path, monkeypatch, task):
+    monkeypatch.chdir(tmp_path)
+    # 沒有安裝 jsonschema 時改用內建的檢查
+    monkeypatch.setattr(task_store, "jsonschema", None)
+
+    async def main():
+        store = await TaskStore(str(tmp_path / "tasks.db"), SCHEMA_PATH).open()
+        try:
+            with pytest.raises(TaskValidationError):
+                await store.insert(task)
+            assert await store.all() == []
+        finally:
+            await store.close()
+
+    asyncio.run(main())
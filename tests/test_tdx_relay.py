@@ -0,0 +1,63 @@
+import asyncio
+from datetime import datetime
+
+from aiohttp.test_utils import TestClient, TestServer
+
+import tdx_relay
+from tdx_relay import ProxyCache, proxy_ttl
+
+
+class Requester:
+    def __init__(self):
+        self.calls = []
+
+    async def get_raw(self, subpath, no_relay=False):
+        self.calls.append(subpath)
+        await asyncio.sleep(0.01)
+        return 200, b'{"UpdateTime":"2026-03-02T08:00:00+08:00"}', {}
+
+
+def test_today_paths_expire_at_midnight():
+    now = datetime(2026, 3, 2, 23, 59, 30)
+    assert proxy_ttl("/v3/Rail/TRA/DailyTrainTimetable/Today", now) == 30
+    assert proxy_ttl("/v3/Rail/TRA/DailyTrainTimetable/TrainDate/2026-03-03", now) == 3600
+    assert proxy_ttl("/v3/Rail/TRA/DailyTrainTimetable/Today", datetime(2026, 3, 2, 12, 0)) == 3600
+
+
+def test_only_the_fetching_request_is_a_miss():
+    async def main():
+        requester = Requester()
+        cache = ProxyCache(requester)
+        key = ("/v3/Rail/TRA/Line", ())
+        results = await asyncio.gather(*[cache.get(key, "/v3/Rail/TRA/Line", 60) for _ in range(3)])
+        assert [result for _, result in results] == ["proxy_miss", "proxy_coalesced", "proxy_coalesced"]
+        assert (await cache.get(key, "/v3/Rail/TRA/Line", 60))[1] == "proxy_hit"
+        assert requester.calls == ["/v3/Rail/TRA/Line"]
+
+    asyncio.run(main())
+
+
+
+def test_each_encoding_has_its_own_etag():
+    async def main():
+        manager = tdx_relay.CacheManager(Requester())
+        manager.train_live = tdx_relay.CachedPayload(b'{"UpdateTime":"2026-03-02T08:00:00+08:00"}')
+        tdx_relay.cache_manager = manager
+        async with TestClient(TestServer(tdx_relay.create_app())) as client:
+
+            async def get(**headers):
+                path = f"{tdx_relay.TRAIN_LIVE_PATH}?$select={tdx_relay.TRAIN_LIVE_ARGS}"
+                async with client.get(path, headers=headers) as response:
+                    return response.status, response.headers
+
+            _, plain = await get(**{"Accept-Encoding": "identity"})
+            _, compressed = await get(**{"Accept-Encoding": "gzip"})
+            assert compressed["Content-Encoding"] == "gzip"
+            assert plain["ETag"] != compressed["ETag"]
+            # 任一編碼的 ETag 都能換得 304
+            status, _ = await get(**{"If-None-Match": compressed["ETag"], "Accept-Encoding": "identity"})
+            assert status == 304
+            status, headers = await get(**{"If-None-Match": plain["ETag"], "Accept-Encoding": "gzip"})
+            assert status == 304 and headers["ETag"] == compressed["ETag"]
+
+    asyncio.run(main())
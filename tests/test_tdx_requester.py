@@ -0,0 +1,209 @@
+import asyncio
+import json
+import time
+
+import pytest
+
+import benchmark
+import tdx_requester
+import train_live
+import train_table
+from fake_tdx import FakeTDX
+from tdx_requester import UNCHANGED, TDXRequester
+from train_live import TrainPositionTable
+from train_table import TrainTable
+
+SUBPATH = f"{train_live.query_path}?{train_live.query_args}"
+
+
+def live_body(delay=0, update_time="2026-03-02T08:00:00+08:00"):
+    return json.dumps(
+        {
+            "UpdateTime": update_time,
+            "SrcUpdateTime": update_time,
+            "TrainLiveBoards": [
+                {
+                    "TrainNo": "101",
+                    "TrainTypeID": "1131",
+                    "StationID": "1000",
+                    "DelayTime": delay,
+                    "UpdateTime": update_time,
+                }
+            ],
+        }
+    ).encode()
+
+
+def run(test):
+    async def main():
+        async with FakeTDX() as server:
+            requester = TDXRequester(
+                api_id="id",
+                api_secret="secret",
+                auth_root=f"{server.url}/token",
+                api_root=server.url,
+                api_relay=None,
+            )
+            requester.limiter = None
+            try:
+                await test(server, requester)
+            finally:
+                await requester.close()
+
+    asyncio.run(main())
+
+
+def test_not_modified_after_commit():
+    async def test(server, requester):
+        server.body, server.etag = live_body(), '"v1"'
+        assert (await requester.get(SUBPATH, conditional=True))["TrainLiveBoards"]
+        # 尚未套用時不帶驗證資訊
+        assert (await requester.get(SUBPATH, conditional=True)) is not UNCHANGED
+        assert server.requests[-1][1] is None
+        requester.commit_validator(SUBPATH)
+        assert (await requester.get(SUBPATH, conditional=True)) is UNCHANGED
+        assert server.requests[-1][1] == '"v1"'
+        server.body, server.etag = live_body(3), '"v2"'
+        assert (await requester.get(SUBPATH, conditional=True))["TrainLiveBoards"][0]["DelayTime"] == 3
+
+    run(test)
+
+
+def test_identical_body_is_unchanged():
+    async def test(server, requester):
+        server.body = live_body()
+        table = await TrainPositionTable().fetch(requester, conditional=True)
+        table.commit(requester)
+        assert not table.unchanged
+        table = await TrainPositionTable().fetch(requester, conditional=True)
+        assert table.unchanged
+        server.body = live_body(5)
+        table = await TrainPositionTable().fetch(requester, conditional=True)
+        assert not table.unchanged and table["101"].delay == 5
+
+    run(test)
+
+
+def test_parse_failure_is_not_remembered():
+    async def test(server, requester):
+        server.body, server.etag = b'{"TrainLiveBoards": []}', '"broken"'
+        for _ in range(2):
+            # 解析失敗的內容不會被當成已套用，同樣的回應仍會再解析一次
+            with pytest.raises(KeyError):
+                await TrainPositionTable().fetch(requester, conditional=True)
+        assert server.requests[-1][1] is None
+
+    run(test)
+
+
+def test_expired_token_is_refreshed():
+    async def test(server, requester):
+        server.body = live_body()
+        server.expire_tokens = 1
+        assert (await requester.get(SUBPATH))["TrainLiveBoards"]
+        assert server.tokens == 2
+        assert [request[2] for request in server.requests] == [
+            "Bearer token-1",
+            "Bearer token-2",
+        ]
+
+    run(test)
+
+
+def test_concurrent_gets_share_one_request():
+    async def test(server, requester):
+        server.body, server.delay = live_body(), 0.1
+        results = await asyncio.gather(*[requester.get(SUBPATH) for _ in range(5)])
+        assert len(server.requests) == 1
+        assert all(result == results[0] for result in results)
+        assert server.requests[0][0] == SUBPATH
+
+    run(test)
+
+
+def run_relays(test):
+    async def main():
+        async with FakeTDX() as slow, FakeTDX() as fast:
+            requester = TDXRequester(
+                api_id="id",
+                api_secret="secret",
+                auth_root=f"{fast.url}/token",
+                api_root=fast.url,
+                api_relay=[slow.url, fast.url],
+            )
+            slow.body = fast.body = live_body()
+            slow.delay = 1
+            # slow 的斷路已到期，下一個請求會成為探測
+            state = requester.relays.states[slow.url]
+            state.open_until, state.trips, state.latency = time.monotonic() - 1, 1, 0.05
+            requester.relays.states[fast.url].latency = 0.5
+            try:
+                await test(requester, state, slow.url)
+            finally:
+                await requester.close()
+
+    asyncio.run(main())
+
+
+def test_probe_cancelled_by_hedge_is_released():
+    async def test(requester, state, slow_url):
+        assert (await requester.get(SUBPATH))["TrainLiveBoards"]
+        await asyncio.sleep(0.05)  # 讓被取消的探測執行完清理
+        assert not state.probing and state.open_until
+        assert requester.relays.choose() == slow_url
+
+    run_relays(test)
+
+
+def test_cancelled_stream_probe_is_released():
+    async def test(requester, state, slow_url):
+        async def read():
+            async for _ in requester.stream(SUBPATH):
+                pass
+
+        task = asyncio.create_task(read())
+        await asyncio.sleep(0.2)
+        assert state.probing
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        assert not state.probing
+        assert requester.relays.choose() == slow_url
+
+    run_relays(test)
+
+
+def test_failed_background_refresh_backs_off():
+    async def test(server, requester):
+        manager = requester.token_manager
+        token = await manager.get()
+        # 進入提前換發的時間窗，但認證伺服器故障
+        manager.refresh_time = 0
+        server.auth_status = 400
+        for _ in range(5):
+            assert await manager.get() == token
+            await asyncio.sleep(0.05)
+        assert server.tokens == 2
+        # 過了等待時間才再試一次
+        manager.failed_time -= manager.refresh_backoff
+        server.auth_status = 200
+        await manager.get()
+        await asyncio.sleep(0.05)
+        assert server.tokens == 3 and await manager.get() != token
+
+    run(test)
+
+
+def test_concurrent_train_table_streams_share_one_download():
+    async def test(server, requester):
+        fixtures, _ = benchmark.synthesize_fixtures(5, 20)
+        server.body, server.delay = json.dumps(fixtures["train_table"]).encode(), 0.1
+        endpoint = tdx_requester.endpoint_label(train_table.QUERY_PATH)
+        before = tdx_requester.fetch_seconds.values.get((endpoint,), [None, 0, 0])[2]
+        tables = await asyncio.gather(*[TrainTable().fetch(requester) for _ in range(3)])
+        assert len(server.requests) == 1
+        assert len(tables[0].trains) == 20
+        assert all(table.trains is tables[0].trains for table in tables)
+        assert tdx_requester.fetch_seconds.values[(endpoint,)][2] == before + 1
+
+    run(test)
@@ -1,5 +1,6 @@
 import time
 from datetime import datetime
+from sys import intern
 
 import tdx_requester
 from station_map import StationTrainslator
@@ -14,18 +15,31 @@ def iso_to_timestamp(iso_string):
 
 
 class TrainPosition:
+    __slots__ = ("train_no", "station_id", "delay", "update_time")
+
     def __init__(self, train_pos_data):
-        self.train_no = train_pos_data["TrainNo"]
-        self.station_id = train_pos_data["StationID"]
+        self.train_no = intern(train_pos_data["TrainNo"])
+        self.station_id = intern(train_pos_data["StationID"])
         self.delay = train_pos_data["DelayTime"]
         self.update_time = train_pos_data["UpdateTime"]
 
+    def dump(self):
+        return tuple(getattr(self, name) for name in self.__slots__)
+
+    @classmethod
+    def load(cls, values):
+        train_pos = cls.__new__(cls)
+        train_no, station_id, train_pos.delay, train_pos.update_time = values
+        train_pos.train_no = intern(train_no)
+        train_pos.station_id = intern(station_id)
+        return train_pos
+
     def __repr__(self):
         return self.train_no
 
 
-async def fetch_train_position(requester):
-    data = await requester.get(query_path + "?" + query_args)
+async def fetch_train_position(requester, conditional=False):
+    data = await requester.get(query_path + "?" + query_args, conditional=conditional)
     return data
 
 
@@ -35,20 +49,57 @@ class TrainPositionTable:
         self.last_fetched_time = None
         self.update_time = None
         self.src_update_time = None
+        self.unchanged = False
 
-    async def fetch(self, requester):
-        data = await fetch_train_position(requester)
+    async def fetch(self, requester, conditional=False):
+        data = await fetch_train_position(requester, conditional)
         self.last_fetched_time = time.time()
+        # 資料與上次相同時不解析，由呼叫端沿用舊的表
+        if data is tdx_requester.UNCHANGED:
+            self.unchanged = True
+            return self
+        return self.parse(data)
+
+    def commit(self, requester):
+        # 套用這份動態後，之後的 conditional 請求才以它為基準
+        requester.commit_validator(query_path + "?" + query_args)
+
+    def parse(self, data):
         self.update_time = iso_to_timestamp(data["UpdateTime"])
         self.src_update_time = iso_to_timestamp(data["SrcUpdateTime"])
         for train_pos_data in data["TrainLiveBoards"]:
             self.table[train_pos_data["TrainNo"]] = TrainPosition(train_pos_data)
         return self
 
+    def to_snapshot(self):
+        self.assert_fetched()
+        return (
+            self.last_fetched_time,
+            self.update_time,
+            self.src_update_time,
+            [train_pos.dump() for train_pos in self.table.values()],
+        )
+
+    def from_snapshot(self, snapshot):
+        self.last_fetched_time, self.update_time, self.src_update_time, values = (
+            snapshot
+        )
+        for train_pos in map(TrainPosition.load, values):
+            self.table[train_pos.train_no] = train_pos
+        return self
+
     def assert_fetched(self):
         if self.last_fetched_time is None:
             raise Exception("Service position not fetched")
 
+    def diff(self, other):
+        # 回傳延誤時間或是否在線上有變化的車次
+        changed = set(self.table.keys()).symmetric_difference(other.table.keys())
+        for train_no, train_pos in other.table.items():
+            if train_no in self.table and self.table[train_no].delay != train_pos.delay:
+                changed.add(train_no)
+        return changed
+
     def __contains__(self, train_no):
         return train_no in self.table
 
@@ -64,6 +115,7 @@ async def main():
     requester = tdx_requester.TDXRequester()
     table = await TrainPositionTable().fetch(requester)
     translator = await StationTrainslator().fetch(requester)
+    await requester.close()
     for service_live in table.values():
         print(
             f"{service_live}現在在{translator[service_live.station_id]}，{f'晚{service_live.delay}分' if service_live.delay > 0 else '準點'}"
@@ -1,5 +1,8 @@
 import asyncio
+from sys import intern
+
 import tdx_requester
+from station_table import time_to_minutes
 
 QUERY_PATH = "/v3/Rail/TRA/DailyTrainTimetable/Today"
 QUERY_PATH_DATE = "/v3/Rail/TRA/DailyTrainTimetable/TrainDate"
@@ -7,21 +10,66 @@ query_args = ""
 
 
 class Stop:
+    __slots__ = (
+        "stop_sequence",
+        "station_id",
+        "arrival",
+        "departure",
+        "arrival_minutes",
+        "departure_minutes",
+    )
+
     def __init__(self, stop_data):
         self.stop_sequence = stop_data["StopSequence"]
-        self.station_id = stop_data["StationID"]
-        self.arrival = stop_data["ArrivalTime"]
-        self.departure = stop_data["DepartureTime"]
+        self.station_id = intern(stop_data["StationID"])
+        self.arrival = intern(stop_data["ArrivalTime"])
+        self.departure = intern(stop_data["DepartureTime"])
+        self.arrival_minutes = time_to_minutes(self.arrival)
+        self.departure_minutes = time_to_minutes(self.departure)
+
+    def dump(self):
+        return tuple(getattr(self, name) for name in self.__slots__)
+
+    @classmethod
+    def load(cls, values):
+        stop = cls.__new__(cls)
+        for name, value in zip(cls.__slots__, values):
+            setattr(stop, name, value)
+        return stop
 
     def __repr__(self):
         return self.station_id
 
 
 class StopTable:
+    __slots__ = ("table",)
+
     def __init__(self, stop_table_data):
         self.table = {}
-        for stop_data in stop_table_data:
-            self.table[stop_data["StationID"]] = Stop(stop_data)
+        # 依停靠順序走訪，時間倒退即代表跨日，之後的停靠都加上一天
+        offset = 0
+        previous = 0
+        for stop_data in sorted(stop_table_data, key=lambda s: s["StopSequence"]):
+            stop = Stop(stop_data)
+            if stop.arrival_minutes + offset < previous:
+                offset += 24 * 60
+            stop.arrival_minutes += offset
+            if stop.departure_minutes + offset < stop.arrival_minutes:
+                offset += 24 * 60
+            stop.departure_minutes += offset
+            previous = stop.departure_minutes
+            self.table[stop.station_id] = stop
+
+    def dump(self):
+        return [stop.dump() for stop in self.table.values()]
+
+    @classmethod
+    def load(cls, values):
+        stop_table = cls.__new__(cls)
+        stop_table.table = {}
+        for stop in map(Stop.load, values):
+            stop_table.table[stop.station_id] = stop
+        return stop_table
 
     def __contains__(self, station_id):
         return station_id in self.table
@@ -29,15 +77,32 @@ class StopTable:
     def __getitem__(self, station_id):
         return self.table[station_id]
 
+    def values(self):
+        return self.table.values()
+
 
 class Train:
+    __slots__ = (
+        "train_no",
+        "direction",
+        "train_type_id",
+        "train_type_code",
+        "start_station_id",
+        "end_station_id",
+        "trip_line",
+        "suspended",
+        "stop_table",
+        "overnight_id",
+    )
+
     def __init__(self, train_data):
         train_info_data = train_data["TrainInfo"]
-        self.train_no = train_info_data["TrainNo"]
+        self.train_no = intern(train_info_data["TrainNo"])
         self.direction = train_info_data["Direction"]
-        self.train_type_id = train_info_data["TrainTypeID"]
-        self.start_station_id = train_info_data["StartingStationID"]
-        self.end_station_id = train_info_data["EndingStationID"]
+        self.train_type_id = intern(train_info_data["TrainTypeID"])
+        self.train_type_code = intern(train_info_data["TrainTypeCode"])
+        self.start_station_id = intern(train_info_data["StartingStationID"])
+        self.end_station_id = intern(train_info_data["EndingStationID"])
         self.trip_line = train_info_data["TripLine"]
         self.suspended = train_info_data["SuspendedFlag"]
         self.stop_table = StopTable(train_data["StopTimes"])
@@ -47,6 +112,19 @@ class Train:
             else None
         )
 
+    def dump(self):
+        return tuple(
+            self.stop_table.dump() if name == "stop_table" else getattr(self, name)
+            for name in self.__slots__
+        )
+
+    @classmethod
+    def load(cls, values):
+        train = cls.__new__(cls)
+        for name, value in zip(cls.__slots__, values):
+            setattr(train, name, StopTable.load(value) if name == "stop_table" else value)
+        return train
+
     def __repr__(self):
         return self.train_no
 
@@ -63,31 +141,89 @@ def parse_train_data(data):
     return trains
 
 
+async def parse_train_stream(chunks):
+    # 邊下載邊解析，不保留整份 JSON，尖峰記憶體接近最終的物件大小
+    trains = {}
+    async for train_data in tdx_requester.iter_json_items(chunks, "TrainTimetables"):
+        trains[train_data["TrainInfo"]["TrainNo"]] = Train(train_data)
+    return trains
+
+
 async def fetch_train_table(requester, date=None):
-    if date is None:
-        data = await requester.get(QUERY_PATH)
-    else:
-        data = await requester.get(f"{QUERY_PATH_DATE}/{date}")
-    return parse_train_data(data)
+    path = QUERY_PATH if date is None else f"{QUERY_PATH_DATE}/{date}"
+    # 同時重新取得的呼叫端共用同一次下載，解析後的車次只會被讀取，可以共用
+    return await requester.get_stream(path, parse_train_stream)
+
+
+def build_station_index(trains):
+    # station_id -> {train_no: stop_sequence}
+    station_index = {}
+    for train in trains.values():
+        for stop in train.stop_table.values():
+            if stop.station_id not in station_index:
+                station_index[stop.station_id] = {}
+            station_index[stop.station_id][train.train_no] = stop.stop_sequence
+    return station_index
 
 
 class TrainTable:
     def __init__(self, date=None, data=None):
         self.trains = None
+        self.station_index = None
+        self.reachable_cache = {}
         self.fetched = False
         self.date = date
         self.parse(data) if data else None
 
     async def fetch(self, requester):
         self.trains = await fetch_train_table(requester, self.date)
+        self.build_index()
         self.fetched = True
         return self
     
     def parse(self, data):
         self.trains = parse_train_data(data)
+        self.build_index()
         self.fetched = True
         return self
 
+    def to_snapshot(self):
+        self.assert_fetched()
+        return (self.date, [train.dump() for train in self.trains.values()])
+
+    def from_snapshot(self, snapshot):
+        self.date, trains = snapshot
+        self.trains = {}
+        for train in map(Train.load, trains):
+            self.trains[train.train_no] = train
+        self.build_index()
+        self.fetched = True
+        return self
+
+    def build_index(self):
+        self.station_index = build_station_index(self.trains)
+        self.reachable_cache = {}
+
+    def reachable(self, origin_id, destination_id):
+        # 先停靠 origin_id 再停靠 destination_id 的車次，結果在同一份時刻表內不會變，直接快取
+        key = (origin_id, destination_id)
+        if key not in self.reachable_cache:
+            origin = self.station_index.get(origin_id, {})
+            destination = self.station_index.get(destination_id, {})
+            if len(origin) > len(destination):
+                self.reachable_cache[key] = frozenset(
+                    train_no
+                    for train_no, stop_sequence in destination.items()
+                    if train_no in origin and origin[train_no] < stop_sequence
+                )
+            else:
+                self.reachable_cache[key] = frozenset(
+                    train_no
+                    for train_no, stop_sequence in origin.items()
+                    if train_no in destination and stop_sequence < destination[train_no]
+                )
+        return self.reachable_cache[key]
+
     def assert_fetched(self):
         if not self.fetched:
             raise Exception("Train table not fetched")
@@ -106,6 +242,7 @@ class TrainTable:
 async def main():
     requester = tdx_requester.TDXRequester()
     train_table = await TrainTable().fetch(requester)
+    await requester.close()
     for train in train_table.values():
         if train.overnight_id is not None:
             print(f"{train}是跨日班次")
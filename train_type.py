@@ -60,6 +60,20 @@ class TrainTypeTranslator:
         self.fetched = True
         return self
 
+    def to_snapshot(self):
+        self.assert_fetched()
+        return [
+            (train_type.id, train_type.code, train_type.name, train_type.ailas)
+            for train_type in self.train_types.values()
+        ]
+
+    def from_snapshot(self, snapshot):
+        self.train_types = {}
+        for id, code, name, ailas in snapshot:
+            self.train_types[id] = TrainType(id, code, name, ailas)
+        self.fetched = True
+        return self
+
     def assert_fetched(self):
         if not self.fetched:
             raise Exception("Train type not fetched")
@@ -97,6 +111,7 @@ class TrainTypeTranslator:
 async def main():
     requester = tdx_requester.TDXRequester()
     translator = await TrainTypeTranslator(ailas=True).fetch(requester)
+    await requester.close()
     print(translator["1100"])
 
 